@@ -0,0 +1,74 @@
+import torch
+from torch.utils.data import default_collate
+import torchvision.transforms as transforms
+from PIL import Image
+
+
+def load_transforms(load_size):
+    """Deterministic per-sample part of the batched pipeline: fixed-size [0, 1] tensors.
+
+    The center crop only matters for non-square images, which must share a shape to be collated.
+    """
+    return [transforms.Resize(load_size, Image.BICUBIC),
+            transforms.CenterCrop(load_size),
+            transforms.ToTensor()]
+
+
+class BatchAugment():
+    """Random crop, random horizontal flip and normalization of a whole (N, C, H, W) batch.
+
+    Every sample gets its own crop offset and flip, drawn for the whole batch at once from
+    `generator` (the global torch RNG if None, which DataLoader workers and train.py already
+    seed). Off the CPU the crops are one indexing kernel over the batch; on the CPU each sample
+    is one strided copy into the output instead, since there the index arithmetic of the gather
+    costs more than the copies. `gather` forces either path. Normalization runs once over the batch.
+    """
+
+    def __init__(self, size, flip=True, mean=0.5, std=0.5, generator=None, gather=None):
+        self.size = size
+        self.flip = flip
+        self.mean = mean
+        self.std = std
+        self.generator = generator
+        self.gather = gather
+
+    def __call__(self, batch, generator=None):
+        generator = generator or self.generator
+        n, channels, height, width = batch.shape
+        tops = torch.randint(0, height - self.size + 1, (n,), generator=generator)
+        lefts = torch.randint(0, width - self.size + 1, (n,), generator=generator)
+        flips = torch.rand(n, generator=generator) < 0.5 if self.flip else torch.zeros(n, dtype=torch.bool)
+
+        gather = batch.device.type != 'cpu' if self.gather is None else self.gather
+        if gather:
+            offsets = torch.arange(self.size)
+            rows = tops[:, None] + offsets
+            cols = lefts[:, None] + torch.where(flips[:, None], offsets.flip(0), offsets)
+            # Broadcast to (N, C, size, size) index grids, so the gather writes a contiguous batch
+            index = (torch.arange(n)[:, None, None, None], torch.arange(channels)[None, :, None, None],
+                     rows[:, None, :, None], cols[:, None, None, :])
+            crops = batch[tuple(t.to(batch.device, non_blocking=True) for t in index)]
+        else:
+            crops = batch.new_empty((n, channels, self.size, self.size))
+            for i, (top, left, flip) in enumerate(zip(tops.tolist(), lefts.tolist(), flips.tolist())):
+                crop = batch[i, :, top:top + self.size, left:left + self.size]
+                crops[i] = crop.flip(-1) if flip else crop
+        return crops.sub_(self.mean).div_(self.std)
+
+
+class AugmentCollate():
+    """collate_fn that augments the collated image batches inside the DataLoader workers."""
+
+    def __init__(self, augment, keys=('A', 'B')):
+        self.augment = augment
+        self.keys = keys
+
+    def __call__(self, samples):
+        batch = default_collate(samples)
+        generator = None
+        if 'seed' in batch:
+            # Seeded by the first sample's seed from PairSampler, so the draws do not depend on the worker
+            generator = torch.Generator().manual_seed(int(batch['seed'][0]))
+        for key in self.keys:
+            batch[key] = self.augment(batch[key], generator)
+        return batch
@@ -0,0 +1,403 @@
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+
+from models import GENERATOR_ARCHS
+from models import Generator
+from models import Discriminator
+from utils import ReplayBuffer
+from utils import weights_init_normal
+from datasets import ImageDataset
+from datasets import pack_folder
+from augment import AugmentCollate, BatchAugment, load_transforms
+from train import train_step
+
+
+def peak_memory_mb(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    # ru_maxrss is in KB on Linux; every configuration runs in its own process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'python': sys.version.split()[0], 'torch': torch.__version__, 'platform': platform.platform(),
+            'processor': platform.processor(), 'cpu_count': os.cpu_count(), 'torch_threads': torch.get_num_threads(),
+            'cuda': torch.cuda.get_device_name(0) if torch.cuda.is_available() else None, 'git_commit': commit,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def bench_network(kind='generator', batch_size=1, size=256, nc=1, steps=10, warmup=2, cuda=False, seed=0,
+                  arch='resnet_9blocks'):
+    """Forward and forward+backward images per second of a Generator preset or the Discriminator."""
+    torch.manual_seed(seed)
+    device = torch.device('cuda' if cuda else 'cpu')
+    net = (Generator(nc, nc, **GENERATOR_ARCHS[arch]) if kind == 'generator' else Discriminator(nc)).to(device)
+    net.apply(weights_init_normal)
+    x = torch.rand(batch_size, nc, size, size, device=device) * 2 - 1
+
+    with torch.no_grad():
+        for _ in range(warmup):
+            net(x)
+        synchronize(device)
+        start = time.perf_counter()
+        for _ in range(steps):
+            net(x)
+        synchronize(device)
+        forward = time.perf_counter() - start
+
+    for _ in range(warmup):
+        net(x).mean().backward()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(steps):
+        net.zero_grad(set_to_none=True)
+        net(x).mean().backward()
+    synchronize(device)
+    backward = time.perf_counter() - start
+    return {'forward_images_per_s': steps * batch_size / forward,
+            'train_images_per_s': steps * batch_size / backward}
+
+
+def synthetic_dataset(root, n_images=64, size=286, nc=1):
+    rng = np.random.RandomState(0)
+    for domain in ('A', 'B'):
+        os.makedirs(os.path.join(root, 'train', domain), exist_ok=True)
+        for i in range(n_images):
+            pixels = rng.randint(0, 256, (size, size) if nc == 1 else (size, size, nc), dtype=np.uint8)
+            Image.fromarray(pixels).save(os.path.join(root, 'train', domain, '%04d.png' % i))
+        pack_folder(os.path.join(root, 'train', domain), os.path.join(root, 'train', domain))
+    return root
+
+
+def bench_dataloader(dataroot, n_cpu=0, batch_size=1, size=256, batches=50, packed=False, cache=False,
+                     augment='sample', cuda=False):
+    """Training-pipeline samples per second out of the DataLoader; a resize cache is built before timing.
+
+    `augment` is where crop, flip and normalization run: per sample with PIL ('sample'), per collated
+    batch in the workers ('worker') or per batch after the transfer to the device ('device').
+    """
+    transforms_ = [transforms.Resize(int(size * 1.12), Image.BICUBIC),
+                   transforms.RandomCrop(size),
+                   transforms.RandomHorizontalFlip(),
+                   transforms.ToTensor(),
+                   transforms.Normalize([0.5], [0.5])]
+    collate_fn, device_augment = None, None
+    if augment != 'sample':
+        transforms_ = load_transforms(int(size * 1.12))
+        if augment == 'worker':
+            collate_fn = AugmentCollate(BatchAugment(size))
+        else:
+            device_augment = BatchAugment(size)
+    device = torch.device('cuda' if cuda else 'cpu')
+    dataloader = DataLoader(ImageDataset(dataroot, transforms_=transforms_, unaligned=True, packed=packed, cache=cache),
+                            batch_size=batch_size, shuffle=True, num_workers=n_cpu, drop_last=True,
+                            collate_fn=collate_fn)
+    samples = 0
+    # Worker start-up is part of what a training run pays every epoch
+    start = time.perf_counter()
+    while samples < batches * batch_size:
+        for batch in dataloader:
+            if device_augment is not None:
+                device_augment(batch['A'].to(device))
+                device_augment(batch['B'].to(device))
+            samples += len(batch['A'])
+            if samples >= batches * batch_size:
+                break
+    synchronize(device)
+    return {'samples_per_s': samples / (time.perf_counter() - start)}
+
+
+def training_setup(batch_size=1, size=256, input_nc=1, output_nc=1, device='cpu', seed=0, channels_last=False):
+    """Freshly initialized networks, optimizers, replay buffers and a synthetic batch; same seed, same state."""
+    torch.manual_seed(seed)
+    memory_format = torch.channels_last if channels_last else torch.preserve_format
+    nets = (Generator(input_nc, output_nc), Generator(output_nc, input_nc),
+            Discriminator(input_nc), Discriminator(output_nc))
+    for net in nets:
+        net.to(device).apply(weights_init_normal)
+        net.to(memory_format=memory_format)
+    optimizers = (torch.optim.Adam(itertools.chain(nets[0].parameters(), nets[1].parameters()), lr=0.0002,
+                                   betas=(0.5, 0.999)),
+                  torch.optim.Adam(nets[2].parameters(), lr=0.0002, betas=(0.5, 0.999)),
+                  torch.optim.Adam(nets[3].parameters(), lr=0.0002, betas=(0.5, 0.999)))
+    buffers = (ReplayBuffer(seed=seed), ReplayBuffer(seed=seed + 1))
+    real_A = (torch.rand(batch_size, input_nc, size, size, device=device) * 2 - 1).to(memory_format=memory_format)
+    real_B = (torch.rand(batch_size, output_nc, size, size, device=device) * 2 - 1).to(memory_format=memory_format)
+    return nets, optimizers, buffers, real_A, real_B
+
+
+def bench_train_step(batch_size=1, size=256, input_nc=1, output_nc=1, amp='fp32', steps=10, warmup=2,
+                     cuda=False, seed=0, channels_last=False, **step_kwargs):
+    """Full CycleGAN steps per second on synthetic data, per process when run under torch.distributed.
+
+    `step_kwargs` select train_step modes such as fused_d, fused_g or accum_steps.
+    """
+    device = torch.device('cuda' if cuda else 'cpu')
+    nets, optimizers, buffers, real_A, real_B = training_setup(batch_size, size, input_nc, output_nc, device, seed,
+                                                               channels_last)
+    if torch.distributed.is_initialized():
+        nets = tuple(DistributedDataParallel(net) for net in nets)
+    scaler = torch.amp.GradScaler(device.type, enabled=amp == 'fp16')
+
+    for _ in range(warmup):
+        train_step(nets, optimizers, buffers, real_A, real_B, amp=amp, scaler=scaler, **step_kwargs)
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    synchronize(device)
+    if torch.distributed.is_initialized():
+        torch.distributed.barrier()
+    start = time.perf_counter()
+    for _ in range(steps):
+        losses, _ = train_step(nets, optimizers, buffers, real_A, real_B, amp=amp, scaler=scaler, **step_kwargs)
+    synchronize(device)
+    elapsed = time.perf_counter() - start
+    return {'steps_per_s': steps / elapsed, 'images_per_s': steps * batch_size / elapsed,
+            'peak_memory_mb': peak_memory_mb(device), 'loss_G': losses['loss_G'].item()}
+
+
+def check_step_equivalence(batch_size=1, size=64, input_nc=1, output_nc=1, cuda=False, seed=0, **step_kwargs):
+    """Differences in losses and gradients between one train_step with `step_kwargs` and one reference
+    step from the same initial state. Gradients are compared relative to the largest reference gradient
+    of each network; weights after the update are not, since Adam's first step amplifies rounding
+    noise in near-zero gradients to a full learning-rate step."""
+    device = torch.device('cuda' if cuda else 'cpu')
+    runs = []
+    for kwargs in ({}, step_kwargs):
+        nets, optimizers, buffers, real_A, real_B = training_setup(batch_size, size, input_nc, output_nc, device,
+                                                                   seed)
+        losses, _ = train_step(nets, optimizers, buffers, real_A, real_B, **kwargs)
+        runs.append((losses, nets))
+    (losses, nets), (other_losses, other_nets) = runs
+    diff = {'loss_max_abs_diff': max((losses[k] - other_losses[k]).abs().item() for k in losses),
+            'grad_max_rel_diff': 0.0}
+    for net, other in zip(nets, other_nets):
+        pairs = [(p.grad, q.grad) for p, q in zip(net.parameters(), other.parameters()) if p.grad is not None]
+        scale = max(g.abs().max().item() for g, _ in pairs) or 1.0
+        diff['grad_max_rel_diff'] = max([diff['grad_max_rel_diff']] +
+                                        [(g - h).abs().max().item() / scale for g, h in pairs])
+    return diff
+
+
+def _ddp_worker(rank, world_size, port, results, kwargs):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    if kwargs.get('cuda'):
+        torch.cuda.set_device(rank)
+    else:
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    torch.distributed.init_process_group('nccl' if kwargs.get('cuda') else 'gloo', rank=rank, world_size=world_size)
+    metrics = bench_train_step(**kwargs)
+    if rank == 0:
+        results.put(metrics)
+    torch.distributed.destroy_process_group()
+
+
+def bench_ddp(world_size=2, **kwargs):
+    """Aggregate train-step throughput of `world_size` DDP processes on this machine (one per GPU with cuda)."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    results = multiprocessing.get_context('spawn').SimpleQueue()
+    torch.multiprocessing.spawn(_ddp_worker, args=(world_size, port, results, kwargs), nprocs=world_size)
+    metrics = results.get()
+    metrics['images_per_s'] *= world_size
+    return metrics
+
+
+def run_isolated(fn, **kwargs):
+    """Run a benchmark in a fresh process so peak memory is not shared between configurations."""
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(fn, kwds=kwargs)
+
+
+def run_suites(opt):
+    results = []
+
+    def record(suite, config, metrics):
+        results.append({'suite': suite, 'config': config, 'metrics': metrics})
+        print('%-13s %-60s %s' % (suite, json.dumps(config, sort_keys=True),
+                                  ' '.join('%s=%.3f' % item for item in sorted(metrics.items()))))
+
+    grid = list(itertools.product(opt.batch_sizes, opt.sizes))
+    if 'generator' in opt.suite:
+        for arch, (batch_size, size) in itertools.product(opt.archs, grid):
+            config = {'batch_size': batch_size, 'size': size, 'nc': opt.input_nc}
+            if arch != 'resnet_9blocks':
+                config['arch'] = arch
+            record('generator', config, bench_network('generator', batch_size, size, opt.input_nc, opt.steps,
+                                                      opt.warmup, opt.cuda, arch=arch))
+
+    if 'discriminator' in opt.suite:
+        for batch_size, size in grid:
+            config = {'batch_size': batch_size, 'size': size, 'nc': opt.input_nc}
+            record('discriminator', config, bench_network('discriminator', batch_size, size, opt.input_nc, opt.steps,
+                                                          opt.warmup, opt.cuda))
+
+    if 'dataloader' in opt.suite:
+        with tempfile.TemporaryDirectory() as tmp:
+            dataroot = opt.dataroot or synthetic_dataset(tmp, size=int(max(opt.sizes) * 1.12), nc=opt.input_nc)
+            for n_cpu, (batch_size, size) in itertools.product(opt.n_cpus, grid):
+                config = {'n_cpu': n_cpu, 'batch_size': batch_size, 'size': size, 'packed': opt.packed}
+                if opt.cache:
+                    config['cache'] = True
+                record('dataloader', config, bench_dataloader(dataroot, n_cpu, batch_size, size, opt.batches,
+                                                              opt.packed, opt.cache))
+
+    if 'augment' in opt.suite:
+        # Batched crop and flip against the PIL transforms, on the same data and loader settings
+        with tempfile.TemporaryDirectory() as tmp:
+            dataroot = opt.dataroot or synthetic_dataset(tmp, size=int(max(opt.sizes) * 1.12), nc=opt.input_nc)
+            for n_cpu, (batch_size, size) in itertools.product(opt.n_cpus, grid):
+                reference = None
+                for augment in ('sample', 'worker', 'device'):
+                    config = {'n_cpu': n_cpu, 'batch_size': batch_size, 'size': size, 'augment': augment,
+                              'cache': opt.cache}
+                    metrics = bench_dataloader(dataroot, n_cpu, batch_size, size, opt.batches, opt.packed, opt.cache,
+                                               augment, opt.cuda)
+                    reference = reference or metrics['samples_per_s']
+                    metrics['speedup'] = metrics['samples_per_s'] / reference
+                    record('augment', config, metrics)
+
+    for suite, precisions in (('train', ['fp32']), ('amp', ['fp32', opt.amp])):
+        if suite in opt.suite:
+            for (batch_size, size), amp in itertools.product(grid, precisions):
+                config = {'batch_size': batch_size, 'size': size, 'amp': amp}
+                record(suite, config, run_isolated(bench_train_step, batch_size=batch_size, size=size,
+                                                   input_nc=opt.input_nc, output_nc=opt.output_nc, amp=amp,
+                                                   steps=opt.steps, warmup=opt.warmup, cuda=opt.cuda))
+            if suite == 'amp':
+                for fp32, low in zip(results[-2 * len(grid)::2], results[-2 * len(grid) + 1::2]):
+                    print('%s vs fp32 %s: %.2fx steps/s, %+.1f MB peak memory' % (
+                        opt.amp, json.dumps({k: fp32['config'][k] for k in ('batch_size', 'size')}),
+                        low['metrics']['steps_per_s'] / fp32['metrics']['steps_per_s'],
+                        low['metrics']['peak_memory_mb'] - fp32['metrics']['peak_memory_mb']))
+
+    if 'fused' in opt.suite:
+        # Step modes against the reference step: equivalence first, then the speed of both
+        for mode in ('fused_d', 'fused_g'):
+            for batch_size, size in grid:
+                config = {'batch_size': batch_size, 'size': size, 'mode': mode}
+                diff = check_step_equivalence(batch_size, min(size, 64), opt.input_nc, opt.output_nc, cuda=opt.cuda,
+                                              **{mode: True})
+                timings = [run_isolated(bench_train_step, batch_size=batch_size, size=size, input_nc=opt.input_nc,
+                                        output_nc=opt.output_nc, steps=opt.steps, warmup=opt.warmup, cuda=opt.cuda,
+                                        **kwargs) for kwargs in ({}, {mode: True})]
+                record('fused', config, dict(diff, steps_per_s=timings[1]['steps_per_s'],
+                                             reference_steps_per_s=timings[0]['steps_per_s'],
+                                             speedup=timings[1]['steps_per_s'] / timings[0]['steps_per_s']))
+
+    if 'accum' in opt.suite:
+        # batch_sizes are micro-batches here; each optimizer step sees micro_batch * accum_steps images
+        for (micro_batch, size), accum_steps, channels_last in itertools.product(grid, opt.accum_steps, (False, True)):
+            config = {'micro_batch': micro_batch, 'accum_steps': accum_steps, 'size': size,
+                      'channels_last': channels_last}
+            metrics = run_isolated(bench_train_step, batch_size=micro_batch * accum_steps, size=size,
+                                   input_nc=opt.input_nc, output_nc=opt.output_nc, steps=opt.steps, warmup=opt.warmup,
+                                   cuda=opt.cuda, channels_last=channels_last, accum_steps=accum_steps)
+            if accum_steps > 1 and not channels_last:
+                metrics.update(check_step_equivalence(micro_batch * accum_steps, min(size, 64), opt.input_nc,
+                                                      opt.output_nc, cuda=opt.cuda, accum_steps=accum_steps))
+            record('accum', config, metrics)
+
+    if 'ddp' in opt.suite:
+        for batch_size, size in grid:
+            single = None
+            for world_size in opt.world_sizes:
+                config = {'world_size': world_size, 'batch_size': batch_size, 'size': size}
+                metrics = bench_ddp(world_size, batch_size=batch_size, size=size, input_nc=opt.input_nc,
+                                    output_nc=opt.output_nc, steps=opt.steps, warmup=opt.warmup, cuda=opt.cuda)
+                single = single or metrics['images_per_s'] / world_size
+                metrics['scaling_efficiency'] = metrics['images_per_s'] / (single * world_size)
+                record('ddp', config, metrics)
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Print throughput changes against a baseline run and return the regressions."""
+    previous = {(r['suite'], json.dumps(r['config'], sort_keys=True)): r['metrics'] for r in baseline['results']}
+    regressions = []
+    for r in results:
+        old = previous.get((r['suite'], json.dumps(r['config'], sort_keys=True)))
+        if old is None:
+            continue
+        for name, value in r['metrics'].items():
+            if not name.endswith('_per_s') or not old.get(name):
+                continue
+            change = value / old[name] - 1.0
+            flag = 'REGRESSION' if change < -tolerance else ''
+            print('%-13s %-60s %-22s %+7.1f%% %s' % (r['suite'], json.dumps(r['config'], sort_keys=True), name,
+                                                     100 * change, flag))
+            if flag:
+                regressions.append((r['suite'], r['config'], name, change))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--suite', type=str, nargs='+', default=['generator', 'discriminator', 'dataloader', 'train'],
+                        choices=['generator', 'discriminator', 'dataloader', 'train', 'amp', 'ddp', 'fused', 'accum',
+                                 'augment'],
+                        help='benchmarks to run')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 4], help='batch sizes to measure')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256], help='image sizes to measure')
+    parser.add_argument('--n_cpus', type=int, nargs='+', default=[0, 2, 4], help='DataLoader worker counts to measure')
+    parser.add_argument('--archs', type=str, nargs='+', default=['resnet_9blocks'], choices=sorted(GENERATOR_ARCHS),
+                        help='generator presets for the generator suite')
+    parser.add_argument('--accum_steps', type=int, nargs='+', default=[1, 2, 4],
+                        help='micro-batches per optimizer step for the accum suite')
+    parser.add_argument('--world_sizes', type=int, nargs='+', default=[1, 2], help='process counts for the ddp suite')
+    parser.add_argument('--dataroot', type=str, default=None, help='dataset for the dataloader suite (synthetic if unset)')
+    parser.add_argument('--packed', action='store_true', help='read slices from packs built by pack_dataset.py')
+    parser.add_argument('--cache', action='store_true', help='read resized slices from the <dataroot>/.cache packs')
+    parser.add_argument('--input_nc', type=int, default=1, help='number of channels of input data')
+    parser.add_argument('--output_nc', type=int, default=1, help='number of channels of output data')
+    parser.add_argument('--amp', type=str, default='bf16', choices=['bf16', 'fp16'], help='precision compared to fp32')
+    parser.add_argument('--steps', type=int, default=10, help='timed iterations per configuration')
+    parser.add_argument('--warmup', type=int, default=2, help='untimed iterations per configuration')
+    parser.add_argument('--batches', type=int, default=50, help='batches drawn per dataloader configuration')
+    parser.add_argument('--cuda', action='store_true', help='use GPU computation')
+    parser.add_argument('--output', type=str, default='output/benchmark.json', help='where to write the results')
+    parser.add_argument('--baseline', type=str, default=None, help='earlier results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative throughput drop flagged as regression')
+    opt = parser.parse_args()
+    print(opt)
+
+    report = {'env': environment(), 'options': vars(opt), 'results': run_suites(opt)}
+    if os.path.dirname(opt.output):
+        os.makedirs(os.path.dirname(opt.output), exist_ok=True)
+    with open(opt.output, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('Results written to %s' % opt.output)
+
+    if opt.baseline:
+        with open(opt.baseline) as f:
+            regressions = compare(report['results'], json.load(f), opt.tolerance)
+        if regressions:
+            print('%d regression(s) beyond %.0f%%' % (len(regressions), 100 * opt.tolerance))
+            sys.exit(1)
@@ -0,0 +1,110 @@
+import glob
+import os
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def to_cpu(obj):
+    """Recursively snapshot every tensor in `obj` to CPU memory.
+
+    Device tensors are copied asynchronously into pinned memory, so callers must wait on a CUDA
+    event before reading them. Later in-place updates of the live tensors are queued behind the
+    copies on the same stream, so the snapshot is consistent.
+    """
+    if torch.is_tensor(obj):
+        if obj.is_cuda:
+            copy = torch.empty(obj.size(), dtype=obj.dtype, pin_memory=True)
+            return copy.copy_(obj.detach(), non_blocking=True)
+        return obj.detach().clone()
+    if isinstance(obj, dict):
+        return type(obj)((key, to_cpu(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """torch.save to a temporary file that replaces `path` only once it is fully written."""
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class CheckpointManager():
+    """Writes full training-state snapshots in the background and keeps the last `keep_last`."""
+
+    def __init__(self, directory, keep_last=3, background=True):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.keep_last = keep_last
+        self.background = background
+        self.thread = None
+        self.error = None
+
+    def path(self, step):
+        return os.path.join(self.directory, 'checkpoint_%09d.pth' % step)
+
+    def checkpoints(self):
+        return sorted(glob.glob(os.path.join(self.directory, 'checkpoint_*.pth')))
+
+    def latest(self):
+        checkpoints = self.checkpoints()
+        return checkpoints[-1] if checkpoints else None
+
+    def save(self, state, step):
+        # At most one snapshot in flight, so host memory stays bounded
+        self.wait()
+        snapshot = to_cpu(state)
+        event = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            event = torch.cuda.Event()
+            event.record()
+        if self.background:
+            self.thread = threading.Thread(target=self._write, args=(snapshot, event, step))
+            self.thread.start()
+        else:
+            self._write(snapshot, event, step)
+            self.wait()
+
+    def _write(self, snapshot, event, step):
+        try:
+            if event is not None:
+                event.synchronize()
+            atomic_save(snapshot, self.path(step))
+            for path in self.checkpoints()[:-self.keep_last]:
+                os.remove(path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def load(self, path=None, map_location='cpu'):
+        path = path or self.latest()
+        return torch.load(path, map_location=map_location, weights_only=False)
+
+
+def rng_state():
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
@@ -1,28 +1,344 @@
 import glob
+import hashlib
+import json
 import random
 import os
 
-from torch.utils.data import Dataset
+import numpy as np
+import torch
+from torch.utils.data import Dataset, Sampler
 from PIL import Image
 import torchvision.transforms as transforms
 
+
+def _image_to_array(image):
+    array = np.asarray(image)
+    if array.ndim == 2:
+        array = array[None]
+    else:
+        array = array.transpose(2, 0, 1)
+    return np.ascontiguousarray(array)
+
+
+def manifest_path(folder):
+    return os.path.normpath(folder) + '.manifest.npz'
+
+
+def write_manifest(folder, sources=None, patients=None, slices=None, linked=False):
+    """Index the images of `folder` in `<folder>.manifest.npz`, next to the folder.
+
+    File names, sizes and modification times are stored as NumPy arrays in sorted name order,
+    with the source path, patient ID and slice index of each image where the dicts `sources`,
+    `patients` and `slices` (keyed by file name) know them. The folder's own mtime is recorded
+    to tell later whether files were added, removed or renamed since.
+
+    With `linked` the folder holds no files: the manifest lists the names of `sources` and the
+    images are read straight from their source paths.
+    """
+    sources, patients, slices = sources or {}, patients or {}, slices or {}
+    if linked:
+        names = sorted(sources)
+        stats = [os.stat(sources[name]) for name in names]
+    else:
+        # Same files as glob('*.*'): dotted names that are not hidden
+        names = sorted(name for name in os.listdir(folder) if '.' in name and not name.startswith('.') and
+                       os.path.isfile(os.path.join(folder, name)))
+        stats = [os.stat(os.path.join(folder, name)) for name in names]
+    tmp = manifest_path(folder) + '.%d.tmp' % os.getpid()
+    with open(tmp, 'wb') as f:
+        np.savez(f, files=np.array(names, dtype=str),
+                 sizes=np.array([st.st_size for st in stats], dtype=np.int64),
+                 mtimes=np.array([st.st_mtime_ns for st in stats], dtype=np.int64),
+                 sources=np.array([sources.get(name, '') for name in names], dtype=str),
+                 patients=np.array([patients.get(name, '') for name in names], dtype=str),
+                 slices=np.array([slices.get(name, -1) for name in names], dtype=np.int64),
+                 folder_mtime=0 if linked else os.stat(folder).st_mtime_ns, linked=linked)
+    os.replace(tmp, manifest_path(folder))
+
+
+def read_manifest(folder):
+    """Arrays of `<folder>.manifest.npz`, or None if there is none or the folder changed since."""
+    path = manifest_path(folder)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as manifest:
+        manifest = {key: manifest[key] for key in manifest.files}
+    if not manifest.get('linked', False) and int(manifest['folder_mtime']) != os.stat(folder).st_mtime_ns:
+        return None
+    return manifest
+
+
+def list_images(folder):
+    """Sorted image paths of `folder` as a NumPy string array.
+
+    Read from the folder's manifest when it is current, so large folders are not listed at every
+    start; otherwise the folder is globbed. Forked DataLoader workers share the array as one
+    buffer, where reading from a list of string objects touches every refcount and copies its page.
+    """
+    manifest = read_manifest(folder)
+    if manifest is not None:
+        if manifest.get('linked', False):
+            return manifest['sources']
+        return np.char.add(os.path.join(folder, ''), manifest['files'])
+    return np.array(sorted(glob.glob(os.path.join(folder, '*.*'))), dtype=str)
+
+
+def _write_pack(arrays, paths, prefix, dtype='auto', key=''):
+    """Write (C, H, W) uint8/uint16 (or float16 in [0, 1]) arrays back to back to `<prefix>.pack`."""
+    offsets = np.zeros(len(paths), dtype=np.int64)
+    shapes = np.zeros((len(paths), 3), dtype=np.int64)
+    store_dtype = None
+    scale = None
+    offset = 0
+    # Unique temporary names, so processes building the same pack do not clobber each other
+    tmp = '%s.%d.tmp' % (prefix, os.getpid())
+    try:
+        with open(tmp + '.pack', 'wb') as f:
+            for i, (path, array) in enumerate(zip(paths, arrays)):
+                if array.dtype == np.float16:
+                    pixel_scale = 1.0
+                elif array.dtype in (np.uint8, np.uint16):
+                    pixel_scale = float(np.iinfo(array.dtype).max)
+                else:
+                    raise ValueError('Unsupported pixel type %s in %s' % (array.dtype, path))
+                if scale is None:
+                    scale = pixel_scale
+                    store_dtype = np.dtype(np.float16) if dtype == 'float16' else array.dtype
+                elif pixel_scale != scale:
+                    raise ValueError('Mixed 8/16 bit images in %s' % os.path.dirname(path))
+
+                if store_dtype == np.float16 and array.dtype != np.float16:
+                    array = (array / scale).astype(np.float16)
+                f.write(array.tobytes())
+                offsets[i] = offset
+                shapes[i] = array.shape
+                offset += array.size
+    except BaseException:
+        os.remove(tmp + '.pack')
+        raise
+    os.replace(tmp + '.pack', prefix + '.pack')
+
+    # The index goes last: a pack is only picked up once its index is complete
+    with open(tmp + '.npz', 'wb') as f:
+        np.savez(f, offsets=offsets, shapes=shapes, dtype=store_dtype.str,
+                 scale=1.0 if store_dtype == np.float16 else scale,
+                 files=np.array([os.path.basename(p) for p in paths]), key=key)
+    os.replace(tmp + '.npz', prefix + '.pack.npz')
+
+
+def pack_folder(folder, prefix, dtype='auto'):
+    """Pack every image of `folder` into `<prefix>.pack` with its index in `<prefix>.pack.npz`.
+
+    Slices are stored channel-first and back to back in one flat array. With dtype='auto' the
+    raw 8/16 bit pixels are kept; 'float16' stores them already scaled to [0, 1].
+    """
+    files = list_images(folder)
+    assert len(files) > 0, 'No images found in %s' % folder
+    _write_pack((_image_to_array(Image.open(path)) for path in files), files, prefix, dtype)
+
+
+# Transforms that give the same output on every call; a leading run of them can be cached
+DETERMINISTIC_TRANSFORMS = (transforms.Resize, transforms.CenterCrop, transforms.Grayscale)
+
+
+def split_transforms(transforms_):
+    """Split a transform list into its deterministic leading part and the per-sample rest."""
+    n = 0
+    while n < len(transforms_) and isinstance(transforms_[n], DETERMINISTIC_TRANSFORMS):
+        n += 1
+    return transforms_[:n], transforms_[n:]
+
+
+def _signature(files):
+    """Name, size and modification time of the source images (or of the pack they live in).
+
+    Every image is stat'ed, so an image edited in place invalidates the cache like an added one.
+    """
+    paths = [files.path] if isinstance(files, PackedSlices) else files
+    stats = [(path, os.stat(path)) for path in paths]
+    return [(os.path.basename(path), st.st_size, st.st_mtime_ns) for path, st in stats]
+
+
+def cached_slices(files, prefix, pre_transforms):
+    """Slices of `files` (image paths or PackedSlices) after `pre_transforms`, as a pack at `prefix`.
+
+    The pack is built on first use and rebuilt when the transforms or the source files change.
+    Images keep their 8/16 bit pixels; slices from a pack are already tensors and are stored as
+    float16.
+    """
+    key = hashlib.sha1(json.dumps([[repr(t) for t in pre_transforms], _signature(files)]).encode()).hexdigest()
+    if os.path.exists(prefix + '.pack.npz'):
+        with np.load(prefix + '.pack.npz') as index:
+            if 'key' in index and str(index['key']) == key:
+                return PackedSlices(prefix)
+
+    transform = transforms.Compose(pre_transforms)
+    if isinstance(files, PackedSlices):
+        arrays = (transform(files[i]).numpy().astype(np.float16) for i in range(len(files)))
+        paths = [os.path.join(os.path.dirname(files.path), name) for name in files.files]
+    else:
+        arrays = (_image_to_array(transform(Image.open(path))) for path in files)
+        paths = files
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    _write_pack(arrays, paths, prefix, key=key)
+    return PackedSlices(prefix)
+
+
+class PackedSlices(object):
+    """Read-only view of a pack written by `pack_folder`.
+
+    The data file is memory-mapped lazily in each process, so DataLoader workers share the page
+    cache instead of pickling a copy of the array.
+    """
+
+    def __init__(self, prefix):
+        index = np.load(prefix + '.pack.npz')
+        self.path = prefix + '.pack'
+        self.offsets = index['offsets']
+        self.shapes = index['shapes']
+        self.dtype = np.dtype(str(index['dtype']))
+        self.scale = float(index['scale'])
+        self.files = index['files']
+        self._data = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if self._data is None:
+            # Copy-on-write keeps the mapping writable for torch.from_numpy; nothing writes to it
+            self._data = np.memmap(self.path, dtype=self.dtype, mode='c')
+        shape = self.shapes[index]
+        start = self.offsets[index]
+        view = self._data[start:start + shape.prod()].reshape(shape)
+        if view.dtype == np.uint16:
+            view = view.astype(np.int32)
+        return torch.from_numpy(view).float().div_(self.scale)
+
+
 class ImageDataset(Dataset):
-    def __init__(self, root, transforms_=None, unaligned=False, mode='train'):
-        self.transform = transforms.Compose(transforms_)
+    def __init__(self, root, transforms_=None, unaligned=False, mode='train', packed=False, cache=False):
         self.unaligned = unaligned
+        self.packed = packed
+
+        if packed:
+            # Packed slices already come out as [0, 1] tensors
+            transforms_ = [t for t in transforms_ if not isinstance(t, transforms.ToTensor)]
+            self.files_A = PackedSlices(os.path.join(root, '%s/A' % mode))
+            self.files_B = PackedSlices(os.path.join(root, '%s/B' % mode))
+        else:
+            self.files_A = list_images(os.path.join(root, '%s/A' % mode))
+            self.files_B = list_images(os.path.join(root, '%s/B' % mode))
+        if cache:
+            # The deterministic transforms (the resize) run once into a pack under <root>/.cache;
+            # only the random crop, flip and normalization are left per sample
+            pre_transforms, transforms_ = split_transforms(transforms_)
+            transforms_ = [t for t in transforms_ if not isinstance(t, transforms.ToTensor)]
+            self.files_A = cached_slices(self.files_A, os.path.join(root, '.cache', mode, 'A'), pre_transforms)
+            self.files_B = cached_slices(self.files_B, os.path.join(root, '.cache', mode, 'B'), pre_transforms)
+            self.packed = True
+        self.transform = transforms.Compose(transforms_)
 
-        self.files_A = sorted(glob.glob(os.path.join(root, '%s/A' % mode) + '/*.*'))[:]
-        self.files_B = sorted(glob.glob(os.path.join(root, '%s/B' % mode) + '/*.*'))[:]
+    def _load(self, files, index):
+        if self.packed:
+            return files[index]
+        return Image.open(files[index])
 
     def __getitem__(self, index):
-        item_A = self.transform(Image.open(self.files_A[index % len(self.files_A)]))
+        if isinstance(index, tuple):
+            # (A index, B index, seed) from PairSampler: the random transforms of this sample depend on
+            # its seed only, not on which worker loads it or what that worker loaded before
+            index_A, index_B, seed = index
+            with torch.random.fork_rng(devices=[]):
+                torch.manual_seed(seed)
+                item_A = self.transform(self._load(self.files_A, index_A % len(self.files_A)))
+                item_B = self.transform(self._load(self.files_B, index_B % len(self.files_B)))
+            return {'A': item_A, 'B': item_B, 'seed': seed}
+
+        item_A = self.transform(self._load(self.files_A, index % len(self.files_A)))
 
         if self.unaligned:
-            item_B = self.transform(Image.open(self.files_B[random.randint(0, len(self.files_B) - 1)]))
+            item_B = self.transform(self._load(self.files_B, random.randint(0, len(self.files_B) - 1)))
         else:
-            item_B = self.transform(Image.open(self.files_B[index % len(self.files_B)]))
+            item_B = self.transform(self._load(self.files_B, index % len(self.files_B)))
 
         return {'A': item_A, 'B': item_B}
 
     def __len__(self):
-        return max(len(self.files_A), len(self.files_B))
\ No newline at end of file
+        return max(len(self.files_A), len(self.files_B))
+
+
+def mix_seed(*values):
+    """A 63-bit generator seed from a tuple of integers, e.g. (seed, epoch); distinct tuples give distinct
+    streams, unlike arithmetic such as seed * 1000 + epoch."""
+    digest = hashlib.sha1(':'.join(str(int(value)) for value in values).encode()).digest()
+    return int.from_bytes(digest[:8], 'little') >> 1
+
+
+class PairSampler(Sampler):
+    """Per-epoch (A index, B index, seed) triples for ImageDataset, computed from `seed` and the epoch.
+
+    The order is a shuffle of the dataset like DataLoader(shuffle=True); unaligned B indices are drawn
+    alongside, and each sample gets its own transform seed. The pairing is padded to a multiple of
+    `num_replicas` and rank `rank` takes every num_replicas-th entry, so ranks see disjoint shards.
+    Since everything follows from (seed, epoch), starting mid-epoch only skips a slice: `start`
+    samples of this rank's shard are dropped without loading them.
+    """
+
+    def __init__(self, dataset, seed=0, unaligned=True, shuffle=True, num_replicas=1, rank=0):
+        self.n_A = len(dataset.files_A)
+        self.n_B = len(dataset.files_B)
+        self.length = len(dataset)
+        self.seed = seed
+        self.unaligned = unaligned
+        self.shuffle = shuffle
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch):
+        if epoch != self.epoch:
+            self.start = 0
+        self.epoch = epoch
+
+    def skip(self, samples):
+        """Start the next iteration of the current epoch after `samples` of this rank's samples."""
+        self.start = samples
+
+    def pairs(self):
+        """All of this rank's (A index, B index, seed) triples for the current epoch."""
+        generator = torch.Generator().manual_seed(mix_seed(self.seed, self.epoch))
+        order = torch.randperm(self.length, generator=generator) if self.shuffle else torch.arange(self.length)
+        if self.unaligned:
+            index_B = torch.randint(0, self.n_B, (self.length,), generator=generator)
+        else:
+            index_B = order % self.n_B
+        seeds = torch.randint(0, 2 ** 62, (self.length,), generator=generator)
+        triples = torch.stack([order % self.n_A, index_B, seeds], dim=1)
+
+        # Wrap around so that every rank gets the same number of samples
+        total = len(self) * self.num_replicas
+        triples = triples.repeat((total + self.length - 1) // self.length, 1)[:total]
+        return triples[self.rank::self.num_replicas]
+
+    def __iter__(self):
+        start, self.start = self.start, 0
+        return iter([tuple(pair) for pair in self.pairs()[start:].tolist()])
+
+    def __len__(self):
+        return (self.length + self.num_replicas - 1) // self.num_replicas
+
+    def state_dict(self, consumed=0):
+        """Where to resume once `consumed` samples of the current epoch have been trained on."""
+        return {'seed': self.seed, 'epoch': self.epoch, 'start': consumed}
+
+    def load_state_dict(self, state):
+        self.seed = state['seed']
+        self.epoch = state['epoch']
+        self.start = state['start']
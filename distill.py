@@ -0,0 +1,195 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+
+from models import GENERATOR_ARCHS
+from models import Generator
+from models import add_generator_args
+from models import build_generator
+from models import generator_kwargs
+from model_cost import cost_report, format_cost
+from utils import LambdaLR
+from utils import Logger
+from utils import MetricsSink
+from utils import weights_init_normal
+from datasets import ImageDataset
+from checkpoint import atomic_save
+
+criterion_pixel = torch.nn.L1Loss()
+criterion_feature = torch.nn.L1Loss()
+
+
+def adapters(student, teacher):
+    """1x1 convolutions lifting the student's features to the teacher's channel counts."""
+    return nn.ModuleList(nn.Conv2d(s, t, 1) for s, t in zip(student.feature_channels, teacher.feature_channels))
+
+
+def distill_loss(teacher, student, adapter, real, lambda_pixel=1.0, lambda_feature=1.0):
+    with torch.no_grad():
+        target, target_features = teacher.features(real)
+    output, features = student.features(real)
+    loss_pixel = criterion_pixel(output, target) * lambda_pixel
+    loss_feature = sum(criterion_feature(a(f), t) for a, f, t in zip(adapter, features, target_features))
+    return loss_pixel, loss_feature * lambda_feature / len(features)
+
+
+def evaluate(teacher, student, dataloader, domain, device, max_batches=None):
+    """Mean absolute error (in [0, 1] intensity units) and PSNR of student against teacher outputs."""
+    abs_error, sq_error, count = 0.0, 0.0, 0
+    student.eval()
+    with torch.no_grad():
+        for i, batch in enumerate(dataloader):
+            if max_batches is not None and i >= max_batches:
+                break
+            real = batch[domain].to(device)
+            diff = (student(real) - teacher(real)) * 0.5
+            abs_error += diff.abs().sum().item()
+            sq_error += diff.pow(2).sum().item()
+            count += diff.numel()
+    student.train()
+    mse = sq_error / count
+    return {'mae': abs_error / count, 'psnr': 10 * math.log10(1.0 / mse) if mse > 0 else float('inf')}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_epochs', type=int, default=50, help='number of epochs of distillation')
+    parser.add_argument('--decay_epoch', type=int, default=25, help='epoch to start linearly decaying the learning rate to 0')
+    parser.add_argument('--batchSize', type=int, default=1, help='size of the batches')
+    parser.add_argument('--dataroot', type=str, default='datasets/cbct2ct/', help='root directory of the dataset')
+    parser.add_argument('--lr', type=float, default=0.0002, help='initial learning rate')
+    parser.add_argument('--size', type=int, default=256, help='size of the data crop (squared assumed)')
+    parser.add_argument('--input_nc', type=int, default=1, help='number of channels of input data')
+    parser.add_argument('--output_nc', type=int, default=1, help='number of channels of output data')
+    parser.add_argument('--cuda', action='store_true', help='use GPU computation')
+    parser.add_argument('--n_cpu', type=int, default=8, help='number of cpu threads to use during batch generation')
+    parser.add_argument('--packed', action='store_true', help='read slices from packs built by pack_dataset.py')
+    parser.add_argument('--cache', action='store_true',
+                        help='resize the training slices once into a cache under <dataroot>/.cache')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for reproducible runs')
+    parser.add_argument('--teacher_A2B', type=str, default='output/netG_A2B.pth', help='trained A2B generator')
+    parser.add_argument('--teacher_B2A', type=str, default=None, help='trained B2A generator (also distilled if set)')
+    parser.add_argument('--teacher_arch', type=str, default='resnet_9blocks', choices=sorted(GENERATOR_ARCHS),
+                        help='generator preset of the teachers')
+    parser.add_argument('--lambda_pixel', type=float, default=1.0, help='weight of the output L1 loss')
+    parser.add_argument('--lambda_feature', type=float, default=1.0, help='weight of the feature-matching loss')
+    parser.add_argument('--eval_mode', type=str, default='test', help='dataset split the student is evaluated on')
+    parser.add_argument('--eval_batches', type=int, default=None, help='limit the evaluation to this many batches')
+    parser.add_argument('--output_dir', type=str, default='output/student', help='where the student weights go')
+    parser.add_argument('--log_every', type=int, default=10, help='reduce and print losses every N batches')
+    add_generator_args(parser)
+    parser.set_defaults(arch='lite')
+    opt = parser.parse_args()
+    print(opt)
+
+    if torch.cuda.is_available() and not opt.cuda:
+        print("WARNING: You have a CUDA device, so you should probably run with --cuda")
+
+    if opt.seed is not None:
+        random.seed(opt.seed)
+        np.random.seed(opt.seed)
+        torch.manual_seed(opt.seed)
+    device = torch.device('cuda' if opt.cuda else 'cpu')
+    os.makedirs(opt.output_dir, exist_ok=True)
+
+    ###### Teachers, students and feature adapters ######
+    directions = [('A2B', 'A', opt.teacher_A2B, opt.input_nc, opt.output_nc)]
+    if opt.teacher_B2A:
+        directions.append(('B2A', 'B', opt.teacher_B2A, opt.output_nc, opt.input_nc))
+
+    teachers, students, adapter_sets = {}, {}, {}
+    for name, _, path, input_nc, output_nc in directions:
+        teacher = Generator(input_nc, output_nc, **GENERATOR_ARCHS[opt.teacher_arch]).to(device)
+        teacher.load_state_dict(torch.load(path, map_location=device))
+        teacher.eval()
+        for p in teacher.parameters():
+            p.requires_grad_(False)
+        student = build_generator(opt, input_nc, output_nc).to(device)
+        student.apply(weights_init_normal)
+        teachers[name], students[name] = teacher, student
+        adapter_sets[name] = adapters(student, teacher).to(device)
+
+    parameters = [p for name in students for p in list(students[name].parameters()) +
+                  list(adapter_sets[name].parameters())]
+    optimizer = torch.optim.Adam(parameters, lr=opt.lr, betas=(0.5, 0.999))
+    lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer,
+                                                     lr_lambda=LambdaLR(opt.n_epochs, 0, opt.decay_epoch).step)
+
+    # Same augmentation as train.py; the teacher labels whatever the student sees
+    transforms_ = [transforms.Resize(int(opt.size * 1.12), Image.BICUBIC),
+                   transforms.RandomCrop(opt.size),
+                   transforms.RandomHorizontalFlip(),
+                   transforms.ToTensor(),
+                   transforms.Normalize([0.5], [0.5])]
+    dataloader = DataLoader(ImageDataset(opt.dataroot, transforms_=transforms_, unaligned=True, packed=opt.packed,
+                                         cache=opt.cache),
+                            batch_size=opt.batchSize, shuffle=True, num_workers=opt.n_cpu)
+    eval_transforms = [transforms.ToTensor(),
+                       transforms.Normalize([0.5], [0.5])]
+    eval_loader = DataLoader(ImageDataset(opt.dataroot, transforms_=eval_transforms, mode=opt.eval_mode),
+                             batch_size=opt.batchSize, shuffle=False, num_workers=opt.n_cpu)
+
+    sink = MetricsSink(os.path.join(opt.output_dir, 'metrics.jsonl'))
+    logger = Logger(opt.n_epochs, len(dataloader), log_every=opt.log_every, visdom=False, sink=sink)
+    ###################################
+
+    ###### Distillation ######
+    for epoch in range(1, opt.n_epochs + 1):
+        for batch in tqdm(dataloader, file=sys.stdout):
+            optimizer.zero_grad()
+            losses = {}
+            for name, domain, _, _, _ in directions:
+                loss_pixel, loss_feature = distill_loss(teachers[name], students[name], adapter_sets[name],
+                                                        batch[domain].to(device), opt.lambda_pixel,
+                                                        opt.lambda_feature)
+                losses['loss_%s_pixel' % name] = loss_pixel
+                losses['loss_%s_feature' % name] = loss_feature
+            sum(losses.values()).backward()
+            optimizer.step()
+            logger.log(losses)
+
+        lr_scheduler.step()
+        record = {'kind': 'eval', 'epoch': epoch}
+        for name, domain, _, _, _ in directions:
+            atomic_save(students[name].state_dict(), os.path.join(opt.output_dir, 'netG_%s.pth' % name))
+            metrics = evaluate(teachers[name], students[name], eval_loader, domain, device, opt.eval_batches)
+            record.update({'%s_%s' % (name, k): v for k, v in metrics.items()})
+        sink.write(record)
+        del record['kind'], record['epoch']
+        print('Epoch %03d student vs teacher: %s' % (epoch, ' | '.join('%s: %.4f' % item for item in record.items())))
+    logger.close()
+    ###################################
+
+    ###### Report ######
+    report = {'student': generator_kwargs(opt), 'teacher_arch': opt.teacher_arch}
+    for name, domain, _, input_nc, _ in directions:
+        teacher_cost = cost_report(teachers[name], input_nc, opt.size, device=device)
+        student_cost = cost_report(students[name], input_nc, opt.size, device=device)
+        metrics = evaluate(teachers[name], students[name], eval_loader, domain, device, opt.eval_batches)
+        report[name] = dict(metrics, teacher=teacher_cost, student=student_cost,
+                            speedup=teacher_cost['latency_ms'] / student_cost['latency_ms'])
+        print('%s teacher: %s' % (name, format_cost(teacher_cost)))
+        print('%s student: %s' % (name, format_cost(student_cost)))
+        print('%s student vs teacher: MAE %.4f | PSNR %.2f dB | %.2fx faster' % (
+            name, metrics['mae'], metrics['psnr'], report[name]['speedup']))
+    with open(os.path.join(opt.output_dir, 'distill_report.json'), 'w') as f:
+        json.dump(report, f, indent=1)
+
+    flags = ' '.join('--%s %s' % item for item in [('arch', opt.arch), ('width', opt.width), ('n_blocks', opt.n_blocks),
+                                                   ('separable', opt.separable), ('upsample', opt.upsample)]
+                     if item[1] is not None)
+    print('Student weights in %s; run the inference scripts with %s' % (opt.output_dir, flags))
+    ###################################
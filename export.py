@@ -0,0 +1,151 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import time
+
+import torch
+
+from models import add_generator_args
+from models import build_generator
+
+DYNAMIC_AXES = {0: 'batch', 2: 'height', 3: 'width'}
+
+
+def export_torchscript(netG, path, example):
+    """Trace and freeze `netG`; the graph is shape-polymorphic, so any batch and size divisible by 4 runs."""
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(netG, example))
+    traced.save(path)
+    return path
+
+
+def export_onnx(netG, path, example, opset=17):
+    with torch.no_grad():
+        torch.onnx.export(netG, (example,), path, input_names=['input'], output_names=['output'],
+                          dynamic_axes={'input': DYNAMIC_AXES, 'output': DYNAMIC_AXES}, opset_version=opset,
+                          dynamo=False)
+    return path
+
+
+class OnnxGenerator():
+    """ONNX Runtime session that takes and returns torch tensors like the eager generator."""
+
+    def __init__(self, path, device='cpu'):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('Running %s needs onnxruntime (pip install onnxruntime)' % path)
+        providers = ['CPUExecutionProvider']
+        if torch.device(device).type == 'cuda':
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = onnxruntime.InferenceSession(path, providers=providers)
+
+    def __call__(self, x):
+        output = self.session.run(None, {'input': x.detach().cpu().numpy()})[0]
+        return torch.from_numpy(output).to(x.device)
+
+    def eval(self):
+        return self
+
+
+def load_exported(path, device='cpu'):
+    """Generator from a .pt (TorchScript) or .onnx file written by export.py."""
+    if path.endswith('.onnx'):
+        return OnnxGenerator(path, device)
+    netG = torch.jit.load(path, map_location=device)
+    netG.eval()
+    return netG
+
+
+def check_parity(netG, exported, shapes, device='cpu'):
+    """Largest absolute difference between eager and exported outputs over the given input shapes."""
+    max_diff = 0.0
+    with torch.no_grad():
+        for shape in shapes:
+            x = torch.rand(shape, device=device) * 2 - 1
+            max_diff = max(max_diff, (netG(x) - exported(x)).abs().max().item())
+    return max_diff
+
+
+def time_runtime(load, shape, device='cpu', runs=10):
+    """Cold start (load plus first call) and steady-state images per second of a generator runtime."""
+    x = torch.rand(shape, device=device) * 2 - 1
+    with torch.no_grad():
+        start = time.perf_counter()
+        netG = load()
+        netG(x)
+        if torch.device(device).type == 'cuda':
+            torch.cuda.synchronize(device)
+        cold_start = time.perf_counter() - start
+        start = time.perf_counter()
+        for _ in range(runs):
+            netG(x)
+        if torch.device(device).type == 'cuda':
+            torch.cuda.synchronize(device)
+        throughput = runs * shape[0] / (time.perf_counter() - start)
+    return cold_start, throughput
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--generator', type=str, default='output/netG_A2B.pth', help='generator checkpoint to export')
+    parser.add_argument('--output', type=str, default=None,
+                        help='path without extension for the exported files (default: next to the checkpoint)')
+    parser.add_argument('--formats', type=str, nargs='+', default=['torchscript', 'onnx'],
+                        choices=['torchscript', 'onnx'], help='formats to write')
+    parser.add_argument('--input_nc', type=int, default=1, help='number of channels of input data')
+    parser.add_argument('--output_nc', type=int, default=1, help='number of channels of output data')
+    parser.add_argument('--size', type=int, default=256, help='size of the example input (squared assumed)')
+    parser.add_argument('--opset', type=int, default=17, help='ONNX opset version')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='largest accepted eager/exported difference')
+    parser.add_argument('--runs', type=int, default=10, help='timed calls per runtime (0 to skip timing)')
+    parser.add_argument('--cuda', action='store_true', help='export and check on the GPU')
+    add_generator_args(parser)
+    opt = parser.parse_args()
+    print(opt)
+
+    device = torch.device('cuda' if opt.cuda else 'cpu')
+
+    def load_eager():
+        netG = build_generator(opt, opt.input_nc, opt.output_nc).to(device)
+        netG.load_state_dict(torch.load(opt.generator, map_location=device))
+        return netG.eval()
+
+    netG = load_eager()
+
+    output = opt.output or os.path.splitext(opt.generator)[0]
+    example = torch.rand(1, opt.input_nc, opt.size, opt.size, device=device) * 2 - 1
+    # Other batch sizes and sizes than the traced example, to exercise the dynamic axes
+    shapes = [(1, opt.input_nc, opt.size, opt.size), (2, opt.input_nc, opt.size // 2 + 4, opt.size + 8)]
+
+    paths = []
+    if 'torchscript' in opt.formats:
+        paths.append(export_torchscript(netG, output + '.pt', example))
+    if 'onnx' in opt.formats:
+        paths.append(export_onnx(netG, output + '.onnx', example, opset=opt.opset))
+
+    failed = False
+    for path in paths:
+        try:
+            exported = load_exported(path, device)
+        except ImportError as e:
+            print('%s: written, parity not checked (%s)' % (path, e))
+            continue
+        max_diff = check_parity(netG, exported, shapes, device)
+        failed |= max_diff > opt.tolerance
+        print('%s: max abs difference to eager %.2e (%s)' % (path, max_diff,
+                                                              'ok' if max_diff <= opt.tolerance else 'FAILED'))
+
+    if opt.runs > 0:
+        runtimes = [('eager', load_eager)] + [(path, lambda path=path: load_exported(path, device)) for path in paths]
+        print('%-40s %14s %12s' % ('runtime', 'cold start s', 'images/s'))
+        for name, load in runtimes:
+            try:
+                cold_start, throughput = time_runtime(load, shapes[0], device, opt.runs)
+            except ImportError:
+                continue
+            print('%-40s %14.3f %12.2f' % (name, cold_start, throughput))
+
+    if failed:
+        raise SystemExit('Exported model differs from eager mode beyond %g' % opt.tolerance)
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+import argparse
+import io
+import json
+import threading
+import time
+import urllib.request
+
+import numpy as np
+from PIL import Image
+
+
+def make_body(fmt, size, depth, rng):
+    if fmt == 'png':
+        buffer = io.BytesIO()
+        Image.fromarray(rng.randint(0, 256, (size, size), dtype=np.uint8)).save(buffer, format='png')
+        return buffer.getvalue()
+    buffer = io.BytesIO()
+    np.save(buffer, rng.rand(depth, size, size).astype(np.float32) if depth else
+            rng.rand(size, size).astype(np.float32))
+    return buffer.getvalue()
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=body, method='POST')
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+
+def run(url, body, concurrency, requests):
+    """Send `requests` copies of `body` from `concurrency` threads; returns per-request latencies and errors."""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def client():
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start = time.perf_counter()
+            try:
+                post(url, body)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000', help='address of serve.py')
+    parser.add_argument('--direction', type=str, default='A2B', choices=['A2B', 'B2A'], help='generator to call')
+    parser.add_argument('--format', type=str, default='png', choices=['png', 'npy'], help='request encoding')
+    parser.add_argument('--size', type=int, default=256, help='size of the synthetic slices (squared assumed)')
+    parser.add_argument('--depth', type=int, default=0, help='slices per NPY volume (0: single slices)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16], help='concurrent clients to test')
+    parser.add_argument('--requests', type=int, default=64, help='requests per concurrency level')
+    opt = parser.parse_args()
+    print(opt)
+
+    body = make_body(opt.format, opt.size, opt.depth, np.random.RandomState(0))
+    slices = opt.depth if opt.format == 'npy' and opt.depth else 1
+    url = '%s/translate/%s' % (opt.url.rstrip('/'), opt.direction)
+    # Warm up the service so model initialization is not measured
+    post(url, body)
+
+    print('%12s %10s %12s %10s %10s %10s %7s' % ('concurrency', 'req/s', 'slices/s', 'p50 ms', 'p90 ms', 'p99 ms',
+                                                   'errors'))
+    for concurrency in opt.concurrency:
+        start = time.perf_counter()
+        latencies, errors = run(url, body, concurrency, opt.requests)
+        elapsed = time.perf_counter() - start
+        latencies = np.array(latencies) * 1000 if latencies else np.zeros(1)
+        print('%12d %10.2f %12.2f %10.1f %10.1f %10.1f %7d' % (
+            concurrency, len(latencies) / elapsed, len(latencies) * slices / elapsed, np.percentile(latencies, 50),
+            np.percentile(latencies, 90), np.percentile(latencies, 99), len(errors)))
+
+    with urllib.request.urlopen('%s/metrics' % opt.url.rstrip('/')) as response:
+        print('Service metrics: %s' % json.dumps(json.loads(response.read()), sort_keys=True))
@@ -1,92 +1,213 @@
+import argparse
+import hashlib
+import json
 import os
+import re
 import shutil
-import random
+from concurrent.futures import ThreadPoolExecutor
 
+from datasets import write_manifest
 
-def copy_files(src_dir, dst_dir, prefix, file_list):
-    """
-    将文件从源目录复制到目标目录，并重命名。
+LINK_MODES = ['copy', 'hardlink', 'symlink', 'manifest']
+# (划分, 域, 模态)：A 域为 CBCT，B 域为 CT
+FOLDERS = [('train', 'A', 'cbct'), ('train', 'B', 'ct'), ('test', 'A', 'cbct'), ('test', 'B', 'ct')]
 
-    Args:
-        src_dir (str): 源目录路径。
-        dst_dir (str): 目标目录路径。
-        prefix (str): 文件名前缀。
-        file_list (list): 要复制的文件名列表。
+
+def place_file(src_path, dst_path, link='copy'):
     """
-    os.makedirs(dst_dir, exist_ok=True)
-    for i, file_name in enumerate(file_list):
-        src_path = os.path.join(src_dir, file_name)
-        dst_path = os.path.join(dst_dir, f"{prefix}_{i}.png")
+    按 link 方式把源文件放入数据集目录：复制、硬链接或符号链接（指向源文件的绝对路径）。
+    目标已存在时先删除，以便中断后重跑。
+    """
+    if os.path.lexists(dst_path):
+        os.remove(dst_path)
+    if link == 'hardlink':
+        os.link(src_path, dst_path)
+    elif link == 'symlink':
+        os.symlink(os.path.abspath(src_path), dst_path)
+    else:
         shutil.copy(src_path, dst_path)
 
 
-def prepare_cyclegan_dataset(data_dir, output_dir, train_ratio=0.8):
+def slice_index(path):
+    """源文件名中的最后一个数字作为切片序号，没有则为 -1。"""
+    numbers = re.findall(r'\d+', os.path.splitext(os.path.basename(path))[0])
+    return int(numbers[-1]) if numbers else -1
+
+
+def save_manifest(folder, sources, linked=False):
     """
-    将 CT 和 CBCT 数据组织成 CycleGAN 数据集格式。
+    为目录写入 <folder>.manifest.npz（文件名、大小、修改时间、源路径、患者 ID、切片序号），
+    训练时 datasets.list_images 直接读取它，不必再遍历目录。
 
     Args:
-        data_dir (str): 数据根目录（包含患者子目录）。
-        output_dir (str): 输出数据集目录。
-        train_ratio (float): 训练集比例。
+        folder (str): 数据集目录，例如 train/A。
+        sources (dict): 目标文件名 -> 源文件路径（<患者目录>/<ct|cbct>/<切片>.png）。
+        linked (bool): 目录中没有文件，清单直接指向源文件（--link manifest）。
     """
-    # 获取所有患者目录
-    patient_dirs = [os.path.join(data_dir, d) for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d))]
+    patients = {name: os.path.basename(os.path.dirname(os.path.dirname(src))) for name, src in sources.items()}
+    slices = {name: slice_index(src) for name, src in sources.items()}
+    write_manifest(folder, sources, patients, slices, linked)
 
-    # 初始化文件列表
-    ct_files = []
-    cbct_files = []
 
-    # 遍历每个患者目录
-    for patient_dir in patient_dirs[:10]:
+def list_patients(data_dir, max_patients=None):
+    """
+    收集每个患者的 CT 和 CBCT 切片。
+
+    Args:
+        data_dir (str): 数据根目录（包含患者子目录）。
+        max_patients (int): 只取按名称排序的前若干个患者目录，None 为全部。
+
+    Returns:
+        dict: 患者 ID -> {'ct': [...], 'cbct': [...]}，按文件名排序的源文件绝对路径。
+    """
+    patients = {}
+    patient_ids = sorted(d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d)))
+    for patient in patient_ids[:max_patients]:
+        patient_dir = os.path.abspath(os.path.join(data_dir, patient))
         print(f"Processing patient directory: {patient_dir}")
         ct_dir = os.path.join(patient_dir, 'ct')
         cbct_dir = os.path.join(patient_dir, 'cbct')
 
         # 获取 CT 和 CBCT 文件
         if os.path.exists(ct_dir) and os.path.exists(cbct_dir):
-            ct_files.extend([os.path.join(patient_dir, 'ct', f) for f in os.listdir(ct_dir) if f.endswith('.png')])
-            cbct_files.extend(
-                [os.path.join(patient_dir, 'cbct', f) for f in os.listdir(cbct_dir) if f.endswith('.png')])
+            patients[patient] = {kind: sorted(os.path.join(patient_dir, kind, f)
+                                              for f in os.listdir(os.path.join(patient_dir, kind)) if f.endswith('.png'))
+                                 for kind in ('ct', 'cbct')}
+    return patients
 
-    # 确保 CT 和 CBCT 文件数量一致
-    assert len(ct_files) == len(cbct_files), "CT and CBCT files must have the same length."
 
-    # 随机划分训练集和测试集
-    num_samples = len(ct_files)
-    num_train = int(num_samples * train_ratio)
-    indices = list(range(num_samples))
-    random.shuffle(indices)
-    train_indices = indices[:num_train]
-    test_indices = indices[num_train:]
+def split_patients(patient_ids, train_ratio=0.8, seed=0):
+    """
+    按患者划分训练集和测试集，同一患者的切片不会同时出现在两边。
+
+    患者按 sha1(种子:患者 ID) 排序，前 train_ratio 比例为训练集。每个患者的位置只取决于种子和
+    自己的 ID，所以划分可由种子复现，增减患者时其余患者最多只有边界上的一个换到另一侧。
 
-    # 获取训练集和测试集文件路径
-    ct_train_files = [ct_files[i] for i in train_indices]
-    cbct_train_files = [cbct_files[i] for i in train_indices]
-    ct_test_files = [ct_files[i] for i in test_indices]
-    cbct_test_files = [cbct_files[i] for i in test_indices]
+    Returns:
+        (list, list): 训练集和测试集的患者 ID。
+    """
+    order = sorted(patient_ids, key=lambda p: hashlib.sha1(f'{seed}:{p}'.encode()).hexdigest())
+    num_train = int(len(order) * train_ratio)
+    return sorted(order[:num_train]), sorted(order[num_train:])
 
-    # 复制训练集
-    copy_files('', os.path.join(output_dir, 'train', 'A'), 'cbct', cbct_train_files)
-    copy_files('', os.path.join(output_dir, 'train', 'B'), 'ct', ct_train_files)
 
-    # 复制测试集
-    copy_files('', os.path.join(output_dir, 'test', 'A'), 'cbct', cbct_test_files)
-    copy_files('', os.path.join(output_dir, 'test', 'B'), 'ct', ct_test_files)
+def sync_folder(folder, wanted, previous, link='copy', previous_link='copy', workers=8):
+    """
+    增量同步一个数据集目录：只删除不再需要或源文件已变化的文件，只放入新增的文件。
 
+    Args:
+        folder (str): 数据集目录，例如 train/A。
+        wanted (dict): 目标文件名 -> [源文件路径, 大小, 修改时间]。
+        previous (dict): 上次 split.json 中记录的该目录的条目。
+        link (str): 本次的放置方式，见 LINK_MODES。
+        previous_link (str): 上次的放置方式，改变时全部重新放置。
+        workers (int): 复制或链接文件的线程数。
+
+    Returns:
+        (int, int): 新增和删除的文件数。
+    """
+    keep = {name for name, entry in wanted.items()
+            if previous.get(name) == entry and link == previous_link and
+            (link == 'manifest' or os.path.lexists(os.path.join(folder, name)))}
+    removed = [name for name in previous if name not in keep]
+    added = [name for name in wanted if name not in keep]
+
+    if previous_link != 'manifest':
+        for name in removed:
+            if os.path.lexists(os.path.join(folder, name)):
+                os.remove(os.path.join(folder, name))
+    if link != 'manifest':
+        os.makedirs(folder, exist_ok=True)
+        # 复制大量小文件主要在等待磁盘 IO，多线程即可并行
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(lambda name: place_file(wanted[name][0], os.path.join(folder, name), link), added))
+    return len(added), len(removed)
+
+
+def prepare_cyclegan_dataset(data_dir, output_dir, train_ratio=0.8, seed=0, link='copy', workers=8,
+                             max_patients=None):
+    """
+    将 CT 和 CBCT 数据组织成 CycleGAN 数据集格式。
 
-def main():
-    # 数据路径
-    data_dir = r'D:\Data\cbct_ct'  # 数据根目录
-    output_dir = r'./datasets/cbct2ct'
+    划分结果和每个目录的文件记录在 <output_dir>/split.json 中，重跑时只增删有变化的文件。
+    文件名为 <模态>_<患者 ID>_<切片文件名>.png，不随划分或其他患者变化。
 
-    if os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-    os.makedirs(output_dir, exist_ok=True)
+    Args:
+        data_dir (str): 数据根目录（包含患者子目录）。
+        output_dir (str): 输出数据集目录。
+        train_ratio (float): 训练集患者比例。
+        seed (int): 划分的随机种子。
+        link (str): copy 复制、hardlink 硬链接、symlink 符号链接，manifest 只写清单不放文件。
+        workers (int): 复制或链接文件的线程数。
+        max_patients (int): 只使用前若干个患者，None 为全部。
+    """
+    patients = list_patients(data_dir, max_patients)
+
+    # 确保 CT 和 CBCT 文件数量一致
+    assert sum(len(p['ct']) for p in patients.values()) == sum(len(p['cbct']) for p in patients.values()), \
+        "CT and CBCT files must have the same length."
+
+    train_patients, test_patients = split_patients(patients, train_ratio, seed)
+    print(f"{len(train_patients)} training and {len(test_patients)} test patients")
+
+    split_path = os.path.join(output_dir, 'split.json')
+    if os.path.exists(split_path):
+        with open(split_path) as f:
+            previous = json.load(f)
+    else:
+        # 没有 split.json 的旧目录无法增量同步，清空后重建
+        previous = {'link': link, 'folders': {}}
+        for mode, domain, _ in FOLDERS:
+            shutil.rmtree(os.path.join(output_dir, mode, domain), ignore_errors=True)
+
+    folders = {}
+    for mode, domain, kind in FOLDERS:
+        name = f'{mode}/{domain}'
+        folder = os.path.join(output_dir, mode, domain)
+        os.makedirs(os.path.dirname(folder), exist_ok=True)
+        wanted = {}
+        for patient in (train_patients if mode == 'train' else test_patients):
+            for src_path in patients[patient][kind]:
+                st = os.stat(src_path)
+                stem = os.path.splitext(os.path.basename(src_path))[0]
+                wanted[f"{kind}_{patient}_{stem}.png"] = [src_path, st.st_size, st.st_mtime_ns]
+        added, removed = sync_folder(folder, wanted, previous['folders'].get(name, {}), link, previous['link'],
+                                     workers)
+        save_manifest(folder, {dst: entry[0] for dst, entry in wanted.items()}, linked=link == 'manifest')
+        folders[name] = wanted
+        print(f"{name}: {len(wanted)} files, {added} added, {removed} removed")
+
+    split = {'seed': seed, 'train_ratio': train_ratio, 'link': link,
+             'patients': {'train': train_patients, 'test': test_patients}, 'folders': folders}
+    tmp = split_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(split, f, indent=1, ensure_ascii=False)
+    os.replace(tmp, split_path)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data_dir', type=str, default=r'D:\Data\cbct_ct', help='数据根目录（包含患者子目录）')
+    parser.add_argument('--output_dir', type=str, default=r'./datasets/cbct2ct', help='输出数据集目录')
+    parser.add_argument('--train_ratio', type=float, default=0.8, help='训练集患者比例')
+    parser.add_argument('--seed', type=int, default=0, help='按患者划分的随机种子')
+    parser.add_argument('--link', type=str, default='copy', choices=LINK_MODES,
+                        help='copy 复制，hardlink/symlink 链接源文件，manifest 只写清单')
+    parser.add_argument('--workers', type=int, default=8, help='复制或链接文件的线程数')
+    parser.add_argument('--max_patients', type=int, default=10, help='只使用前若干个患者（0 为全部）')
+    parser.add_argument('--clean', action='store_true', help='删除输出目录后重建，而不是增量同步')
+    opt = parser.parse_args()
+    print(opt)
+
+    if opt.clean and os.path.exists(opt.output_dir):
+        shutil.rmtree(opt.output_dir)
+    os.makedirs(opt.output_dir, exist_ok=True)
 
     # 准备 CycleGAN 数据集
-    prepare_cyclegan_dataset(data_dir, output_dir)
+    prepare_cyclegan_dataset(opt.data_dir, opt.output_dir, opt.train_ratio, opt.seed, opt.link, opt.workers,
+                             opt.max_patients or None)
 
-    print(f"CycleGAN dataset saved to {output_dir}")
+    print(f"CycleGAN dataset saved to {opt.output_dir}")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,104 @@
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+from models import GENERATOR_ARCHS
+from models import Generator
+from models import add_generator_args
+from models import build_generator
+
+
+def count_parameters(net):
+    return sum(p.numel() for p in net.parameters())
+
+
+def count_flops(net, input_size, device='cpu'):
+    """Convolution FLOPs (2 per multiply-add) of one forward pass; norms and activations are not counted."""
+    flops = []
+
+    def conv_hook(module, inputs, output):
+        kernel = module.kernel_size[0] * module.kernel_size[1] * module.in_channels // module.groups
+        flops.append(2 * output.numel() * kernel)
+
+    def deconv_hook(module, inputs, output):
+        kernel = module.kernel_size[0] * module.kernel_size[1] * module.out_channels // module.groups
+        flops.append(2 * inputs[0].numel() * kernel)
+
+    handles = []
+    for m in net.modules():
+        if isinstance(m, nn.ConvTranspose2d):
+            handles.append(m.register_forward_hook(deconv_hook))
+        elif isinstance(m, nn.Conv2d):
+            handles.append(m.register_forward_hook(conv_hook))
+    try:
+        with torch.no_grad():
+            net(torch.zeros(input_size, device=device))
+    finally:
+        for handle in handles:
+            handle.remove()
+    return sum(flops)
+
+
+def measure_latency(net, input_size, device='cpu', runs=10, warmup=2):
+    """Median milliseconds per forward pass without autograd."""
+    x = torch.rand(input_size, device=device) * 2 - 1
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + runs):
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            net(x)
+            if device.type == 'cuda':
+                torch.cuda.synchronize(device)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    return 1000 * sorted(times)[len(times) // 2]
+
+
+def cost_report(net, input_nc=1, size=256, batch_size=1, device='cpu', runs=10):
+    """Parameters, GFLOPs and (with runs > 0) latency of `net` on a batch of size x size images."""
+    device = torch.device(device)
+    input_size = (batch_size, input_nc, size, size)
+    training = net.training
+    net.eval()
+    report = {'params': count_parameters(net), 'gflops': count_flops(net, input_size, device) / 1e9}
+    if runs > 0:
+        report['latency_ms'] = measure_latency(net, input_size, device, runs)
+    net.train(training)
+    return report
+
+
+def format_cost(report):
+    text = '%.2fM params, %.2f GFLOPs' % (report['params'] / 1e6, report['gflops'])
+    if 'latency_ms' in report:
+        text += ', %.1f ms' % report['latency_ms']
+    return text
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input_nc', type=int, default=1, help='number of channels of input data')
+    parser.add_argument('--output_nc', type=int, default=1, help='number of channels of output data')
+    parser.add_argument('--size', type=int, default=256, help='size of the data (squared assumed)')
+    parser.add_argument('--batchSize', type=int, default=1, help='images per forward pass')
+    parser.add_argument('--runs', type=int, default=10, help='timed forward passes (0 to skip latency)')
+    parser.add_argument('--cuda', action='store_true', help='use GPU computation')
+    parser.add_argument('--all', action='store_true', help='report every preset instead of the selected generator')
+    add_generator_args(parser)
+    opt = parser.parse_args()
+    print(opt)
+
+    device = torch.device('cuda' if opt.cuda else 'cpu')
+    if opt.all:
+        nets = [(arch, Generator(opt.input_nc, opt.output_nc, **kwargs)) for arch, kwargs in GENERATOR_ARCHS.items()]
+    else:
+        nets = [(opt.arch, build_generator(opt, opt.input_nc, opt.output_nc))]
+
+    print('%-16s %10s %10s %12s' % ('generator', 'params M', 'GFLOPs', 'latency ms'))
+    for name, net in nets:
+        report = cost_report(net.to(device), opt.input_nc, opt.size, opt.batchSize, device, opt.runs)
+        print('%-16s %10.2f %10.2f %12s' % (name, report['params'] / 1e6, report['gflops'],
+                                            '%.1f' % report['latency_ms'] if 'latency_ms' in report else '-'))
@@ -2,17 +2,25 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 
+def conv3x3(in_features, out_features, separable=False):
+    """Reflection-padded 3x3 convolution, optionally depthwise followed by pointwise."""
+    if not separable:
+        return [nn.ReflectionPad2d(1),
+                nn.Conv2d(in_features, out_features, 3)]
+    return [nn.ReflectionPad2d(1),
+            nn.Conv2d(in_features, in_features, 3, groups=in_features),
+            nn.Conv2d(in_features, out_features, 1)]
+
+
 class ResidualBlock(nn.Module):
-    def __init__(self, in_features):
+    def __init__(self, in_features, separable=False):
         super(ResidualBlock, self).__init__()
 
-        conv_block = [nn.ReflectionPad2d(1),
-                      nn.Conv2d(in_features, in_features, 3),
-                      nn.InstanceNorm2d(in_features),
-                      nn.ReLU(inplace=True),
-                      nn.ReflectionPad2d(1),
-                      nn.Conv2d(in_features, in_features, 3),
-                      nn.InstanceNorm2d(in_features)]
+        conv_block = conv3x3(in_features, in_features, separable)
+        conv_block += [nn.InstanceNorm2d(in_features),
+                       nn.ReLU(inplace=True)]
+        conv_block += conv3x3(in_features, in_features, separable)
+        conv_block += [nn.InstanceNorm2d(in_features)]
 
         self.conv_block = nn.Sequential(*conv_block)
 
@@ -21,17 +29,26 @@ class ResidualBlock(nn.Module):
 
 
 class Generator(nn.Module):
-    def __init__(self, input_nc, output_nc, n_residual_blocks=9):
+    """ResNet generator. The defaults are the original CycleGAN network (and its state_dict keys).
+
+    `width` scales every channel count (64 base channels at 1.0), `separable` makes the residual
+    convolutions depthwise-separable and `upsample='resize'` replaces the transposed convolutions
+    with nearest-neighbour upsampling followed by a 3x3 convolution.
+    """
+
+    def __init__(self, input_nc, output_nc, n_residual_blocks=9, width=1.0, separable=False, upsample='deconv'):
         super(Generator, self).__init__()
+        assert upsample in ('deconv', 'resize'), 'upsample must be deconv or resize'
+        base = max(1, int(round(64 * width)))
 
         # Initial convolution block       
         model = [nn.ReflectionPad2d(3),
-                 nn.Conv2d(input_nc, 64, 7),
-                 nn.InstanceNorm2d(64),
+                 nn.Conv2d(input_nc, base, 7),
+                 nn.InstanceNorm2d(base),
                  nn.ReLU(inplace=True)]
 
         # Downsampling
-        in_features = 64
+        in_features = base
         out_features = in_features * 2
         for _ in range(2):
             model += [nn.Conv2d(in_features, out_features, 3, stride=2, padding=1),
@@ -39,23 +56,29 @@ class Generator(nn.Module):
                       nn.ReLU(inplace=True)]
             in_features = out_features
             out_features = in_features * 2
+        self.feature_layers = [len(model)]
 
         # Residual blocks
         for _ in range(n_residual_blocks):
-            model += [ResidualBlock(in_features)]
+            model += [ResidualBlock(in_features, separable)]
+        self.feature_layers.append(len(model))
+        self.feature_channels = [in_features, in_features]
 
         # Upsampling
         out_features = in_features // 2
         for _ in range(2):
-            model += [nn.ConvTranspose2d(in_features, out_features, 3, stride=2, padding=1, output_padding=1),
-                      nn.InstanceNorm2d(out_features),
+            if upsample == 'deconv':
+                model += [nn.ConvTranspose2d(in_features, out_features, 3, stride=2, padding=1, output_padding=1)]
+            else:
+                model += [nn.Upsample(scale_factor=2, mode='nearest')] + conv3x3(in_features, out_features)
+            model += [nn.InstanceNorm2d(out_features),
                       nn.ReLU(inplace=True)]
             in_features = out_features
             out_features = in_features // 2
 
         # Output layer
         model += [nn.ReflectionPad2d(3),
-                  nn.Conv2d(64, output_nc, 7),
+                  nn.Conv2d(base, output_nc, 7),
                   nn.Tanh()]
 
         self.model = nn.Sequential(*model)
@@ -63,6 +86,54 @@ class Generator(nn.Module):
     def forward(self, x):
         return self.model(x)
 
+    def features(self, x):
+        """Output plus the activations entering and leaving the residual blocks."""
+        features = []
+        for i, layer in enumerate(self.model):
+            x = layer(x)
+            if i + 1 in self.feature_layers:
+                features.append(x)
+        return x, features
+
+
+# Named generator configurations; explicit flags override the preset
+GENERATOR_ARCHS = {
+    'resnet_9blocks': {},
+    'resnet_6blocks': {'n_residual_blocks': 6},
+    'lite': {'width': 0.5, 'n_residual_blocks': 6, 'separable': True, 'upsample': 'resize'},
+    'tiny': {'width': 0.25, 'n_residual_blocks': 4, 'separable': True, 'upsample': 'resize'},
+}
+
+
+def add_generator_args(parser):
+    parser.add_argument('--arch', type=str, default='resnet_9blocks', choices=sorted(GENERATOR_ARCHS),
+                        help='generator preset')
+    parser.add_argument('--width', type=float, default=None, help='generator channel width multiplier')
+    parser.add_argument('--n_blocks', type=int, default=None, help='number of generator residual blocks')
+    parser.add_argument('--separable', type=int, default=None, choices=[0, 1],
+                        help='depthwise-separable residual convolutions')
+    parser.add_argument('--upsample', type=str, default=None, choices=['deconv', 'resize'],
+                        help='transposed convolutions or resize-convolutions')
+    return parser
+
+
+def generator_kwargs(opt):
+    kwargs = dict(GENERATOR_ARCHS[opt.arch])
+    if opt.width is not None:
+        kwargs['width'] = opt.width
+    if opt.n_blocks is not None:
+        kwargs['n_residual_blocks'] = opt.n_blocks
+    if opt.separable is not None:
+        kwargs['separable'] = bool(opt.separable)
+    if opt.upsample is not None:
+        kwargs['upsample'] = opt.upsample
+    return kwargs
+
+
+def build_generator(opt, input_nc, output_nc):
+    """Generator for the --arch preset and override flags added by `add_generator_args`."""
+    return Generator(input_nc, output_nc, **generator_kwargs(opt))
+
 
 class Discriminator(nn.Module):
     def __init__(self, input_nc):
@@ -0,0 +1,105 @@
+import argparse
+import time
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+
+from models import add_generator_args
+from models import build_generator
+from nii_png import pad_image, resample_image
+
+
+def normalize_slices(volume):
+    """Scale every slice to [-1, 1] on its own range, like normalize_to_uint8 + Normalize(0.5, 0.5)."""
+    volume = volume.astype(np.float32)
+    lo = volume.min(axis=(1, 2), keepdims=True)
+    hi = volume.max(axis=(1, 2), keepdims=True)
+    return (volume - lo) / np.maximum(hi - lo, 1e-8) * 2.0 - 1.0
+
+
+def translate_volume(netG, volume, batch_size=8, device='cpu'):
+    """Run a (D, H, W) array in [-1, 1] through the generator, `batch_size` slices at a time."""
+    output = np.empty_like(volume)
+    with torch.no_grad():
+        for start in range(0, len(volume), batch_size):
+            real = torch.from_numpy(volume[start:start + batch_size]).unsqueeze(1).to(device)
+            output[start:start + batch_size] = netG(real).squeeze(1).cpu().numpy()
+    return output
+
+
+def restore_geometry(output, image, padded, resampled):
+    """Map an array on the resampled grid back onto the grid of the source image."""
+    output_image = sitk.GetImageFromArray(output)
+    output_image.CopyInformation(resampled)
+
+    # Undo resample_image: back to the padded grid
+    resample_filter = sitk.ResampleImageFilter()
+    resample_filter.SetReferenceImage(padded)
+    resample_filter.SetTransform(sitk.Transform())
+    resample_filter.SetInterpolator(sitk.sitkLinear)
+    resample_filter.SetUseNearestNeighborExtrapolator(True)
+    resample_filter.SetOutputPixelType(sitk.sitkFloat32)
+    restored = sitk.GetArrayFromImage(resample_filter.Execute(output_image))
+
+    # Undo pad_image: padding only ever grows the upper bound
+    size = image.GetSize()
+    result = sitk.GetImageFromArray(restored[:, :size[1], :size[0]])
+    result.CopyInformation(image)
+    return result
+
+
+def nii_a2b(netG, input_path, output_path, target_size=(256, 256), batch_size=8, device='cpu',
+            out_range=(0.0, 255.0), keep_resampled=False):
+    timings = {}
+    start = time.time()
+    image = sitk.ReadImage(input_path)
+    padded = pad_image(image, target_size=target_size)
+    resampled = resample_image(padded, target_size=target_size)
+    volume = normalize_slices(sitk.GetArrayFromImage(resampled))
+    timings['read'] = time.time() - start
+
+    start = time.time()
+    output = translate_volume(netG, volume, batch_size=batch_size, device=device)
+    output = (output + 1.0) * 0.5 * (out_range[1] - out_range[0]) + out_range[0]
+    timings['infer'] = time.time() - start
+
+    start = time.time()
+    if keep_resampled:
+        result = sitk.GetImageFromArray(output)
+        result.CopyInformation(resampled)
+    else:
+        result = restore_geometry(output, image, padded, resampled)
+    sitk.WriteImage(result, output_path)
+    timings['write'] = time.time() - start
+    return timings
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default='./test_data/brain.nii.gz', help='input volume')
+    parser.add_argument('--output', type=str, default='./test_data/brain_predict.nii.gz', help='output volume')
+    parser.add_argument('--batchSize', type=int, default=8, help='number of slices per generator call')
+    parser.add_argument('--input_nc', type=int, default=1, help='number of channels of input data')
+    parser.add_argument('--output_nc', type=int, default=1, help='number of channels of output data')
+    parser.add_argument('--size', type=int, default=256, help='size of the data (squared assumed)')
+    parser.add_argument('--cuda', action='store_true', help='use GPU computation')
+    parser.add_argument('--generator_A2B', type=str, default='output/netG_A2B.pth',
+                        help='A2B generator checkpoint file')
+    parser.add_argument('--out_range', type=float, nargs=2, default=[0.0, 255.0],
+                        help='intensity range the generator output [-1, 1] is mapped to')
+    parser.add_argument('--keep_resampled', action='store_true',
+                        help='write the output on the resampled size x size grid instead of the source grid')
+    add_generator_args(parser)
+    opt = parser.parse_args()
+    print(opt)
+
+    device = torch.device('cuda' if opt.cuda else 'cpu')
+    netG_A2B = build_generator(opt, opt.input_nc, opt.output_nc).to(device)
+    netG_A2B.load_state_dict(torch.load(opt.generator_A2B, map_location=device))
+    netG_A2B.eval()
+
+    timings = nii_a2b(netG_A2B, opt.input, opt.output, target_size=(opt.size, opt.size),
+                      batch_size=opt.batchSize, device=device, out_range=opt.out_range,
+                      keep_resampled=opt.keep_resampled)
+    print('read %.2fs | infer %.2fs | write %.2fs' % (timings['read'], timings['infer'], timings['write']))
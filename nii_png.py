@@ -1,5 +1,9 @@
+import hashlib
+import json
 import os
 import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import tqdm
@@ -65,6 +69,26 @@ def resample_image(image, target_size=(256, 256)):
     return resampled_image
 
 
+def resampled_geometry(size, spacing, origin, direction, target_size=(256, 256)):
+    """只根据文件头计算 pad_image + resample_image 之后的 spacing、origin 和 direction，不读取像素"""
+    pad_height = max(target_size[0] - size[1], 0)
+    pad_width = max(target_size[1] - size[0], 0)
+    return {'spacing': [spacing[0] * ((size[0] + pad_width) / target_size[0]),
+                        spacing[1] * ((size[1] + pad_height) / target_size[1]),
+                        spacing[2] if len(size) > 2 else 1],
+            'origin': [origin[0] - pad_width * spacing[0] / 2,
+                       origin[1] - pad_height * spacing[1] / 2,
+                       origin[2] if len(size) > 2 else 0],
+            'direction': list(direction)}
+
+
+def save_geometry(folder, size, spacing, origin, direction):
+    """将 PNG 切片所在网格的几何信息保存到 <folder>.geometry.json，png_nii 据此还原 spacing/origin/direction"""
+    geometry = {'size': list(size), 'spacing': list(spacing), 'origin': list(origin), 'direction': list(direction)}
+    with open(os.path.normpath(folder) + '.geometry.json', 'w') as f:
+        json.dump(geometry, f, indent=1)
+
+
 def save_png_images(file_path, ct, cbct, mask):
     """将 ct, cbct, mask 图像保存为 .png 文件"""
     ct_dir = os.path.join(file_path, 'ct')
@@ -104,48 +128,115 @@ def load_images(file_path):
         return None, None, None
 
 
-def transfer_folder(path_in, path_out, target_size=(256, 256)):
-    path_in = r'D:\Data\SynthRAD\Task2\brain'
-    path_out = r'D:\Data\cbct_ct'
+def file_signature(path, use_hash=False):
+    """文件指纹：默认 (大小, 修改时间)，use_hash 时为内容 SHA1"""
+    if not os.path.exists(path):
+        return None
+    if use_hash:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def case_key(file_path_in, target_size, use_hash=False):
+    inputs = {name: file_signature(os.path.join(file_path_in, name + '.nii.gz'), use_hash)
+              for name in ('cbct', 'ct', 'mask')}
+    return {'inputs': inputs, 'target_size': list(target_size)}
+
+
+def transfer_case(file_path_in, file_path_out, target_size=(256, 256)):
+    """处理单个病例并返回耗时（秒），读取失败时返回 None"""
+    start = time.time()
+    cbct, ct, mask = load_images(file_path_in)
+    if cbct is None or ct is None or mask is None:
+        return None
+
+    # 重新生成前清掉旧的切片，避免层数变少时残留
+    if os.path.exists(file_path_out):
+        shutil.rmtree(file_path_out)
+    os.makedirs(file_path_out, exist_ok=True)
+
+    # 将图像转换为 SimpleITK 格式
+    ct_image = sitk.GetImageFromArray(ct)
+    cbct_image = sitk.GetImageFromArray(cbct)
+    mask_image = sitk.GetImageFromArray(mask)
+
+    # 对图像进行填充
+    ct_padded = pad_image(ct_image, target_size=target_size)
+    cbct_padded = pad_image(cbct_image, target_size=target_size)
+    mask_padded = pad_image(mask_image, target_size=target_size)
+
+    # 将填充后的图像重采样至 256x256
+    ct_resampled = resample_image(ct_padded, target_size=target_size)
+    cbct_resampled = resample_image(cbct_padded, target_size=target_size)
+    mask_resampled = resample_image(mask_padded, target_size=target_size)
 
-    if os.path.exists(path_out):
-        shutil.rmtree(path_out)
+    # 将重采样后的图像转换为 NumPy 数组
+    ct_resampled_np = sitk.GetArrayFromImage(ct_resampled)
+    cbct_resampled_np = sitk.GetArrayFromImage(cbct_resampled)
+    mask_resampled_np = sitk.GetArrayFromImage(mask_resampled)
+
+    # 保存为 PNG 格式
+    save_png_images(file_path_out, ct_resampled_np, cbct_resampled_np, mask_resampled_np)
+    # load_images 只返回数组，切片在默认网格上重采样；几何信息从文件头换算
+    for name in ('ct', 'cbct', 'mask'):
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(os.path.join(file_path_in, name + '.nii.gz'))
+        reader.ReadImageInformation()
+        geometry = resampled_geometry(reader.GetSize(), reader.GetSpacing(), reader.GetOrigin(),
+                                      reader.GetDirection(), target_size)
+        save_geometry(os.path.join(file_path_out, name), [target_size[0], target_size[1], reader.GetSize()[2]],
+                      **geometry)
+    return time.time() - start
+
+
+def save_manifest(manifest, manifest_path):
+    tmp = manifest_path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, manifest_path)
+
+
+def transfer_folder(path_in, path_out, target_size=(256, 256), workers=None, use_hash=False, limit=None):
+    """并行预处理整个队列，manifest.json 记录每个病例的输入指纹，未变化的病例直接跳过"""
     os.makedirs(path_out, exist_ok=True)
+    manifest_path = os.path.join(path_out, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
 
     # 遍历文件夹
-    for file in tqdm.tqdm(os.listdir(path_in)[:40]):
-        file_path_in = os.path.join(path_in, file)
-        file_path_out = os.path.join(path_out, file)
-
-        cbct, ct, mask = load_images(file_path_in)
-        if cbct is None or ct is None or mask is None:
+    cases = sorted(d for d in os.listdir(path_in) if os.path.isdir(os.path.join(path_in, d)))[:limit]
+    todo = []
+    for case in cases:
+        key = case_key(os.path.join(path_in, case), target_size, use_hash)
+        if manifest.get(case, {}).get('key') == key and os.path.isdir(os.path.join(path_out, case)):
             continue
-
-        # 创建输出目录
-        os.makedirs(file_path_out, exist_ok=True)
-
-        # 将图像转换为 SimpleITK 格式
-        ct_image = sitk.GetImageFromArray(ct)
-        cbct_image = sitk.GetImageFromArray(cbct)
-        mask_image = sitk.GetImageFromArray(mask)
-
-        # 对图像进行填充
-        ct_padded = pad_image(ct_image, target_size=target_size)
-        cbct_padded = pad_image(cbct_image, target_size=target_size)
-        mask_padded = pad_image(mask_image, target_size=target_size)
-
-        # 将填充后的图像重采样至 256x256
-        ct_resampled = resample_image(ct_padded, target_size=target_size)
-        cbct_resampled = resample_image(cbct_padded, target_size=target_size)
-        mask_resampled = resample_image(mask_padded, target_size=target_size)
-
-        # 将重采样后的图像转换为 NumPy 数组
-        ct_resampled_np = sitk.GetArrayFromImage(ct_resampled)
-        cbct_resampled_np = sitk.GetArrayFromImage(cbct_resampled)
-        mask_resampled_np = sitk.GetArrayFromImage(mask_resampled)
-
-        # 保存为 PNG 格式
-        save_png_images(file_path_out, ct_resampled_np, cbct_resampled_np, mask_resampled_np)
+        todo.append((case, key))
+    print(f"{len(cases) - len(todo)} cases up to date, {len(todo)} to process")
+
+    timings = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(transfer_case, os.path.join(path_in, case), os.path.join(path_out, case),
+                               target_size): (case, key) for case, key in todo}
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+            case, key = futures[future]
+            elapsed = future.result()
+            if elapsed is None:
+                continue
+            timings.append(elapsed)
+            manifest[case] = {'key': key, 'seconds': round(elapsed, 3)}
+            # 每完成一个病例就落盘，中断后重跑只处理剩余病例
+            save_manifest(manifest, manifest_path)
+            tqdm.tqdm.write(f"{case}: {elapsed:.2f}s")
+
+    if timings:
+        print(f"Processed {len(timings)} cases, mean {np.mean(timings):.2f}s, max {np.max(timings):.2f}s per case")
 
 
 def transfer_one_case(path, result, target_size=(256, 256)):
@@ -157,6 +248,8 @@ def transfer_one_case(path, result, target_size=(256, 256)):
     ct_padded = pad_image(image, target_size=target_size)
     ct_resampled = resample_image(ct_padded, target_size=target_size)
     ct_resampled_np = sitk.GetArrayFromImage(ct_resampled)
+    save_geometry(result, ct_resampled.GetSize(), ct_resampled.GetSpacing(), ct_resampled.GetOrigin(),
+                  ct_resampled.GetDirection())
 
     for i in tqdm.tqdm(range(len(ct_resampled_np))):
         ct_img = normalize_to_uint8(ct_resampled_np[i])
@@ -166,7 +259,7 @@ def transfer_one_case(path, result, target_size=(256, 256)):
 if __name__ == '__main__':
     # path_in = r'D:\Data\SynthRAD\Task2\brain'
     # path_out = r'D:\Data\cbct_ct'
-    # transfer_folder(path_in, path_out)
+    # transfer_folder(path_in, path_out, workers=os.cpu_count())
 
     path = r'./test_data/brain.nii.gz'
     result = r'./test_data/brain'
@@ -0,0 +1,21 @@
+import argparse
+import os
+
+from datasets import pack_folder
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataroot', type=str, default='datasets/cbct2ct/', help='root directory of the dataset')
+    parser.add_argument('--modes', type=str, nargs='+', default=['train', 'test'], help='splits to pack')
+    parser.add_argument('--dtype', type=str, default='auto', choices=['auto', 'float16'],
+                        help='keep raw 8/16 bit pixels or store [0, 1] float16')
+    opt = parser.parse_args()
+    print(opt)
+
+    for mode in opt.modes:
+        for domain in ('A', 'B'):
+            folder = os.path.join(opt.dataroot, mode, domain)
+            if not os.path.isdir(folder):
+                continue
+            pack_folder(folder, folder, dtype=opt.dtype)
+            print('Packed %s -> %s.pack' % (folder, folder))
@@ -1,42 +1,172 @@
+import argparse
+import gzip
+import json
 import os
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import SimpleITK as sitk
 from PIL import Image
 
+from nii_png import resampled_geometry
+
+
+def list_slices(folder_path):
+    """按文件名中的最后一个数字排序（nii_png 保存为 0.png, 1.png, ..., 10.png，不能按字符串排序）"""
+    def key(name):
+        numbers = re.findall(r'\d+', os.path.splitext(name)[0])
+        return (int(numbers[-1]) if numbers else -1, name)
+
+    image_files = sorted((f for f in os.listdir(folder_path) if f.endswith('.png')), key=key)
+    return [os.path.join(folder_path, f) for f in image_files]
+
+
+def decode_slices(paths, out, workers=None):
+    """多线程解码 PNG，直接写入预分配的 out[i]（PIL 解码时释放 GIL）"""
+    def decode(i):
+        array = np.asarray(Image.open(paths[i]))
+        if array.shape != out.shape[1:]:
+            raise ValueError(f"{paths[i]} has shape {array.shape}, expected {out.shape[1:]}")
+        out[i] = array
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(decode, range(len(paths))))
+    return out
+
+
+def load_png_sequence(folder_path, workers=None):
+    """按第一张切片的形状和类型预分配 (D, H, W[, C]) 数组，并行解码所有切片"""
+    paths = list_slices(folder_path)
+    first = np.asarray(Image.open(paths[0]))
+    volume = np.empty((len(paths),) + first.shape, dtype=first.dtype)
+    return decode_slices(paths, volume, workers)
 
-def load_png_sequence(folder_path):
-    image_files = sorted([f for f in os.listdir(folder_path) if f.endswith('.png')])
-    images = []
 
-    for file in image_files:
-        img = Image.open(os.path.join(folder_path, file))
-        img_array = np.array(img)
-        images.append(img_array)
+def nifti_header(volume, spacing, origin, direction=None):
+    """
+    体数据的 NIfTI 文件头（到 vox_offset 为止）。由 SimpleITK 写出只含一张切片的同类图像得到，
+    再把 dim[3] 改为层数，所以方向、像素类型等约定与 sitk.WriteImage 完全一致。
+    """
+    template = sitk.GetImageFromArray(volume[:1], isVector=volume.ndim == 4)
+    template.SetSpacing(spacing)
+    template.SetOrigin(origin)
+    if direction is not None:
+        template.SetDirection(direction)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'header.nii')
+        sitk.WriteImage(template, path)
+        with open(path, 'rb') as f:
+            header = bytearray(f.read())
+    vox_offset = int(np.frombuffer(header, dtype='<f4', count=1, offset=108)[0])
+    header = header[:vox_offset]
+    # dim 为 short[8]，从第 40 字节开始
+    header[46:48] = np.array([len(volume)], dtype='<i2').tobytes()
+    return bytes(header)
 
-    volume = np.stack(images, axis=0)
-    return volume
 
+def write_nifti(volume, output_path, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0), direction=None,
+                compresslevel=6):
+    """
+    不转换为 SimpleITK 图像，直接把预分配的 (D, H, W[, C]) 数组写成 .nii / .nii.gz，内存中只有这一份体数据。
+    标量图像按切片直接写出数组内存；向量（RGB）图像在 NIfTI 中按分量存放，逐切片取出每个分量。
+    """
+    header = nifti_header(volume, spacing, origin, direction)
+    opener = (lambda path: gzip.open(path, 'wb', compresslevel=compresslevel)) \
+        if output_path.endswith('.gz') else (lambda path: open(path, 'wb'))
+    with opener(output_path) as f:
+        f.write(header)
+        if volume.ndim == 4:
+            for c in range(volume.shape[3]):
+                for z in range(len(volume)):
+                    f.write(volume[z, :, :, c].astype(volume.dtype.newbyteorder('<'), order='C').data)
+        else:
+            for z in range(len(volume)):
+                f.write(volume[z].astype(volume.dtype.newbyteorder('<'), copy=False).data)
 
-def save_as_nifti(volume, output_path, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0)):
-    sitk_image = sitk.GetImageFromArray(volume)
+
+def geometry_path(folder_path):
+    """PNG 目录的几何信息文件 <folder>.geometry.json，与目录并列，不会被当作切片读取"""
+    return os.path.normpath(folder_path) + '.geometry.json'
+
+
+def read_geometry(size, geometry=None, reference=None):
+    """
+    体数据的 spacing、origin 和 direction。
+
+    Args:
+        size (tuple): PNG 体数据的 (x, y, z) 尺寸。
+        geometry (str): nii_png 保存的 .geometry.json。
+        reference (str): 原始 .nii.gz，只读取文件头；尺寸与 PNG 不同时换算到
+                         nii_png.pad_image + resample_image 得到的网格。
+
+    Returns:
+        dict: spacing, origin, direction；都没有给出时为空。
+    """
+    if geometry:
+        with open(geometry) as f:
+            info = json.load(f)
+        if 'size' in info and list(info['size']) != list(size):
+            raise ValueError(f"{geometry} describes a {info['size']} volume, the slices give {list(size)}")
+        return {key: info[key] for key in ('spacing', 'origin', 'direction') if key in info}
+    if reference:
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(reference)
+        reader.ReadImageInformation()
+        ref_size = reader.GetSize()
+        if ref_size[2] != size[2]:
+            raise ValueError(f"{reference} has {ref_size[2]} slices, the folder has {size[2]}")
+        if tuple(ref_size[:2]) == tuple(size[:2]):
+            return {'spacing': reader.GetSpacing(), 'origin': reader.GetOrigin(), 'direction': reader.GetDirection()}
+        return resampled_geometry(ref_size, reader.GetSpacing(), reader.GetOrigin(), reader.GetDirection(),
+                                  target_size=size[:2])
+    return {}
+
+
+def save_as_nifti(volume, output_path, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0), direction=None):
+    sitk_image = volume if isinstance(volume, sitk.Image) else sitk.GetImageFromArray(volume)
 
     sitk_image.SetSpacing(spacing)
     sitk_image.SetOrigin(origin)
+    if direction is not None:
+        sitk_image.SetDirection(direction)
 
     sitk.WriteImage(sitk_image, output_path)
 
 
-def png_to_nii(folder_path, output_path, spacing=(1.0, 1.0, 1.0), origin=(0.0, 0.0, 0.0)):
-    volume = load_png_sequence(folder_path)
+def png_to_nii(folder_path, output_path, spacing=None, origin=None, direction=None, geometry=None, reference=None,
+               workers=None):
+    """
+    PNG 序列转 NIfTI，解码和写出都直接使用预分配的数组。几何信息优先级：显式参数 > geometry > reference > 目录旁的 <folder>.geometry.json
+    > 默认（spacing 1，origin 0）。
+    """
+    start = time.time()
+    volume = load_png_sequence(folder_path, workers)
+    elapsed = time.time() - start
 
-    save_as_nifti(volume, output_path, spacing, origin)
+    if geometry is None and reference is None and os.path.exists(geometry_path(folder_path)):
+        geometry = geometry_path(folder_path)
+    info = read_geometry((volume.shape[2], volume.shape[1], len(volume)), geometry, reference)
+    write_nifti(volume, output_path, spacing or info.get('spacing', (1.0, 1.0, 1.0)),
+                origin or info.get('origin', (0.0, 0.0, 0.0)), direction or info.get('direction'))
+    return elapsed
 
 
 if __name__ == '__main__':
-    folder_path = r'./test_data/brain_a2b'
-    output_path = r'./test_data/brain_predict.nii.gz'
-
-    spacing = (1.0, 1.0, 1.0)
-    origin = (0.0, 0.0, 0.0)
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', type=str, default='./test_data/brain_a2b', help='PNG 切片目录')
+    parser.add_argument('--output', type=str, default='./test_data/brain_predict.nii.gz', help='输出 .nii.gz')
+    parser.add_argument('--geometry', type=str, default=None,
+                        help='nii_png 保存的 <folder>.geometry.json（默认读取输入目录旁的同名文件）')
+    parser.add_argument('--reference', type=str, default=None, help='提供几何信息的原始 .nii.gz')
+    parser.add_argument('--spacing', type=float, nargs=3, default=None, help='覆盖 spacing')
+    parser.add_argument('--origin', type=float, nargs=3, default=None, help='覆盖 origin')
+    parser.add_argument('--workers', type=int, default=None, help='解码线程数')
+    opt = parser.parse_args()
+    print(opt)
 
-    png_to_nii(folder_path, output_path, spacing, origin)
+    decode_time = png_to_nii(opt.input, opt.output, opt.spacing, opt.origin, geometry=opt.geometry,
+                             reference=opt.reference, workers=opt.workers)
+    print(f"Decoded in {decode_time:.2f}s, saved to {opt.output}")
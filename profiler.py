@@ -0,0 +1,126 @@
+import collections
+import contextlib
+import os
+import time
+
+import numpy as np
+import torch
+
+_NULL = contextlib.nullcontext()
+
+
+class _Phase():
+    __slots__ = ('profiler', 'name', 'start', 'record')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._sync()
+        self.record = None
+        if self.profiler.trace is not None:
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.profiler._sync()
+        self.profiler.add(self.name, time.perf_counter() - self.start)
+        if self.record is not None:
+            self.record.__exit__(*exc)
+
+
+class StepProfiler():
+    """Wall time per phase of the training step, with rolling percentiles.
+
+    A phase entered several times in one step, e.g. once per accumulated micro-batch, counts
+    with its total. When disabled, `phase` hands back a shared null context, so instrumented
+    code pays one attribute lookup and a call per phase.
+    """
+
+    def __init__(self, enabled=False, sync=False, window=1000, trace_start=None, trace_steps=0,
+                 trace_dir='output/profile'):
+        self.enabled = enabled
+        self.sync = sync and torch.cuda.is_available()
+        self.times = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.current = collections.defaultdict(float)
+        self.trace_start = trace_start
+        self.trace_steps = trace_steps
+        self.trace_dir = trace_dir
+        self.trace = None
+        self.steps = 0
+        self.marker = time.perf_counter()
+
+    def _sync(self):
+        if self.sync:
+            torch.cuda.synchronize()
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL
+        return _Phase(self, name)
+
+    def add(self, name, seconds):
+        self.current[name] += seconds
+        self.marker = time.perf_counter()
+
+    def lap(self, name):
+        """Record the time since the last phase or step ended, e.g. waiting on the DataLoader."""
+        if self.enabled:
+            self._start_trace()
+            self.add(name, time.perf_counter() - self.marker)
+
+    def _start_trace(self):
+        # Steps count from 1: the trace of START..START+STEPS-1 begins once START-1 steps are done
+        if self.trace is None and self.trace_start is not None and self.steps == max(self.trace_start, 1) - 1:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if torch.cuda.is_available():
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(activities=activities, record_shapes=True, profile_memory=True)
+            self.trace.__enter__()
+
+    def step(self):
+        if not self.enabled:
+            return
+        for name, seconds in self.current.items():
+            self.times[name].append(seconds)
+        self.current.clear()
+        self.steps += 1
+        if self.trace is not None and self.steps == max(self.trace_start, 1) - 1 + self.trace_steps:
+            self.trace.__exit__(None, None, None)
+            os.makedirs(self.trace_dir, exist_ok=True)
+            path = os.path.join(self.trace_dir, 'trace_steps_%d_%d.json' % (
+                self.steps - self.trace_steps + 1, self.steps))
+            self.trace.export_chrome_trace(path)
+            print('\nProfiler trace written to %s' % path)
+            self.trace = None
+        else:
+            self._start_trace()
+        self.marker = time.perf_counter()
+
+    def summary(self):
+        summary = {}
+        for name, times in self.times.items():
+            times = np.array(times) * 1000
+            summary[name] = {'mean_ms': float(times.mean()), 'p50_ms': float(np.percentile(times, 50)),
+                             'p90_ms': float(np.percentile(times, 90)), 'p99_ms': float(np.percentile(times, 99))}
+        return summary
+
+    def report(self, epoch, sink=None):
+        if not self.enabled or not self.times:
+            return
+        summary = self.summary()
+        total = sum(phase['mean_ms'] for phase in summary.values())
+        print('\nStep profile, epoch %d (last %d steps)' % (epoch, max(len(t) for t in self.times.values())))
+        print('%-16s %10s %10s %10s %10s %7s' % ('phase', 'mean ms', 'p50 ms', 'p90 ms', 'p99 ms', 'share'))
+        for name, phase in summary.items():
+            print('%-16s %10.2f %10.2f %10.2f %10.2f %6.1f%%' % (name, phase['mean_ms'], phase['p50_ms'],
+                                                              phase['p90_ms'], phase['p99_ms'],
+                                                              100 * phase['mean_ms'] / total))
+        if sink is not None:
+            record = {'kind': 'profile', 'epoch': epoch, 'time': time.time()}
+            for name, phase in summary.items():
+                for stat, value in phase.items():
+                    record['%s_%s' % (name, stat)] = value
+            sink.write(record)
@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+import argparse
+import copy
+import json
+import os
+import warnings
+
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.utils.data import DataLoader
+
+from models import add_generator_args
+from models import build_generator
+from datasets import ImageDataset
+from distill import evaluate
+from export import time_runtime
+
+
+def quantize_generator(netG, calibration, engine='x86'):
+    """Post-training static int8 quantization of a Generator with FX graph mode.
+
+    Convolutions, InstanceNorm2d, ReLU, the residual adds and Tanh run on quint8 tensors.
+    ReflectionPad2d has no quantized pattern, so the graph dequantizes around each pad.
+    ConvTranspose2d gets the backend's per-tensor weight observer, since per-channel
+    transposed convolutions are not supported. `calibration` yields (N, C, H, W)
+    batches in [-1, 1].
+    """
+    torch.backends.quantized.engine = engine
+    qconfig_mapping = get_default_qconfig_mapping(engine)
+    netG = copy.deepcopy(netG).cpu().eval()
+    batches = iter(calibration)
+    first = next(batches)
+    with warnings.catch_warnings():
+        # torch.ao.quantization announces its move to torchao on every call
+        warnings.simplefilter('ignore')
+        prepared = prepare_fx(netG, qconfig_mapping, (first,))
+        with torch.no_grad():
+            prepared(first)
+            for batch in batches:
+                prepared(batch)
+        quantized = convert_fx(prepared)
+    return quantized
+
+
+def save_quantized(quantized, path, example):
+    """Freeze the quantized graph to TorchScript, runnable through test_A2B.py --exported_A2B."""
+    with torch.no_grad():
+        scripted = torch.jit.freeze(torch.jit.trace(quantized, example))
+    scripted.save(path)
+    return scripted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--generator', type=str, default='output/netG_A2B.pth', help='generator checkpoint to quantize')
+    parser.add_argument('--output', type=str, default=None,
+                        help='quantized TorchScript file (default: <generator>_int8.pt)')
+    parser.add_argument('--dataroot', type=str, default='datasets/cbct2ct/', help='root directory of the dataset')
+    parser.add_argument('--domain', type=str, default='A', choices=['A', 'B'], help='input domain of the generator')
+    parser.add_argument('--input_nc', type=int, default=1, help='number of channels of input data')
+    parser.add_argument('--output_nc', type=int, default=1, help='number of channels of output data')
+    parser.add_argument('--size', type=int, default=256, help='size of the data (squared assumed)')
+    parser.add_argument('--batchSize', type=int, default=4, help='slices per calibration and evaluation batch')
+    parser.add_argument('--calib_batches', type=int, default=32, help='training batches used for calibration')
+    parser.add_argument('--eval_mode', type=str, default='test', help='dataset split the drift is measured on')
+    parser.add_argument('--eval_batches', type=int, default=None, help='limit the evaluation to this many batches')
+    parser.add_argument('--engine', type=str, default='x86', choices=['x86', 'fbgemm', 'onednn', 'qnnpack'],
+                        help='quantized backend (qnnpack on ARM)')
+    parser.add_argument('--runs', type=int, default=10, help='timed calls for the speedup measurement')
+    parser.add_argument('--n_cpu', type=int, default=8, help='number of cpu threads to use during batch generation')
+    add_generator_args(parser)
+    opt = parser.parse_args()
+    print(opt)
+
+    netG = build_generator(opt, opt.input_nc, opt.output_nc)
+    netG.load_state_dict(torch.load(opt.generator, map_location='cpu'))
+    netG.eval()
+    output = opt.output or os.path.splitext(opt.generator)[0] + '_int8.pt'
+
+    # Whole slices as the inference scripts see them
+    transforms_ = [transforms.Resize(opt.size, Image.BICUBIC),
+                   transforms.CenterCrop(opt.size),
+                   transforms.ToTensor(),
+                   transforms.Normalize([0.5], [0.5])]
+    calibration_loader = DataLoader(ImageDataset(opt.dataroot, transforms_=transforms_, unaligned=True),
+                                    batch_size=opt.batchSize, shuffle=True, num_workers=opt.n_cpu)
+    calibration = (batch[opt.domain] for i, batch in zip(range(opt.calib_batches), calibration_loader))
+    quantized = quantize_generator(netG, calibration, opt.engine)
+    example = torch.rand(1, opt.input_nc, opt.size, opt.size) * 2 - 1
+    scripted = save_quantized(quantized, output, example)
+    print('Quantized generator written to %s (%.1f MB, fp32 %.1f MB)' % (
+        output, os.path.getsize(output) / 2 ** 20, os.path.getsize(opt.generator) / 2 ** 20))
+
+    eval_loader = DataLoader(ImageDataset(opt.dataroot, transforms_=transforms_, mode=opt.eval_mode),
+                             batch_size=opt.batchSize, shuffle=False, num_workers=opt.n_cpu)
+    drift = evaluate(netG, scripted, eval_loader, opt.domain, 'cpu', opt.eval_batches)
+    shape = (opt.batchSize, opt.input_nc, opt.size, opt.size)
+    _, fp32_throughput = time_runtime(lambda: netG, shape, runs=opt.runs)
+    _, int8_throughput = time_runtime(lambda: scripted, shape, runs=opt.runs)
+    report = dict(drift, engine=opt.engine, fp32_images_per_s=fp32_throughput, int8_images_per_s=int8_throughput,
+                  speedup=int8_throughput / fp32_throughput, threads=torch.get_num_threads())
+    print('int8 vs fp32: MAE %.4f | PSNR %.2f dB | %.2f vs %.2f images/s (%.2fx) on %d threads' % (
+        report['mae'], report['psnr'], int8_throughput, fp32_throughput, report['speedup'], report['threads']))
+    with open(os.path.splitext(output)[0] + '.json', 'w') as f:
+        json.dump(report, f, indent=1)
@@ -0,0 +1,288 @@
+#!/usr/bin/python3
+
+import argparse
+import collections
+import io
+import json
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+from torchvision.utils import save_image
+
+from models import add_generator_args
+from models import build_generator
+from nii_a2b import normalize_slices
+from export import load_exported
+
+PNG_MAGIC = b'\x89PNG'
+NPY_MAGIC = b'\x93NUMPY'
+
+
+class ServiceMetrics():
+    """Request latency, batch size and throughput over a rolling window, safe to update from any thread."""
+
+    def __init__(self, window=1000, rate_window=10.0):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.rate_window = rate_window
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.completions = collections.deque()
+        self.counts = collections.Counter()
+
+    def request(self, latency, slices):
+        with self.lock:
+            self.latencies.append(latency)
+            self.counts['requests'] += 1
+            self.counts['slices'] += slices
+
+    def error(self):
+        with self.lock:
+            self.counts['errors'] += 1
+
+    def batch(self, size):
+        now = time.time()
+        with self.lock:
+            self.batch_sizes.append(size)
+            self.counts['batches'] += 1
+            self.completions.append((now, size))
+            while self.completions and self.completions[0][0] < now - self.rate_window:
+                self.completions.popleft()
+
+    def snapshot(self, queue_depth):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            now = time.time()
+            recent = sum(n for t, n in self.completions if t >= now - self.rate_window)
+            snapshot = dict(self.counts, uptime_s=now - self.start, queue_depth=queue_depth,
+                            slices_per_s=recent / min(self.rate_window, max(now - self.start, 1e-6)),
+                            mean_batch_size=float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0)
+        if len(latencies):
+            for q in (50, 90, 99):
+                snapshot['latency_p%d_ms' % q] = float(np.percentile(latencies, q))
+        return snapshot
+
+
+class DynamicBatcher():
+    """Merges slices from concurrent requests into generator batches.
+
+    A batch is closed once `max_batch` slices are waiting or the oldest has waited `max_wait_ms`;
+    only slices of the same shape go into one batch. `workers` threads share the generator.
+    """
+
+    def __init__(self, netG, max_batch=8, max_wait_ms=10, workers=1, device='cpu', metrics=None):
+        self.netG = netG
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.device = device
+        self.metrics = metrics
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, slices):
+        """Queue (C, H, W) tensors; returns one Future per slice."""
+        futures = [Future() for _ in slices]
+        now = time.time()
+        with self.cond:
+            self.pending.extend((now, tensor, future) for tensor, future in zip(slices, futures))
+            self.cond.notify_all()
+        return futures
+
+    def _next_batch(self):
+        with self.cond:
+            while True:
+                while not self.pending:
+                    if self.closed:
+                        return None
+                    self.cond.wait()
+                deadline = self.pending[0][0] + self.max_wait
+                while 0 < len(self.pending) < self.max_batch and not self.closed:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                # Another worker may have taken everything meanwhile
+                if self.pending:
+                    break
+
+            shape = self.pending[0][1].shape
+            batch, others = [], []
+            while self.pending and len(batch) < self.max_batch:
+                item = self.pending.popleft()
+                (batch if item[1].shape == shape else others).append(item)
+            self.pending.extendleft(reversed(others))
+            if self.pending:
+                # Let another worker start on the rest right away
+                self.cond.notify()
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            try:
+                with torch.no_grad():
+                    output = self.netG(torch.stack([tensor for _, tensor, _ in batch]).to(self.device)).cpu()
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), result in zip(batch, output):
+                future.set_result(result)
+            if self.metrics is not None:
+                self.metrics.batch(len(batch))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+def decode(body, input_nc):
+    """Request body to a list of (C, H, W) slices in [-1, 1] plus the response encoding."""
+    if body.startswith(PNG_MAGIC):
+        image = Image.open(io.BytesIO(body)).convert('L' if input_nc == 1 else 'RGB')
+        tensor = transforms.Normalize([0.5], [0.5])(transforms.ToTensor()(image))
+        return [tensor], 'png', None
+    if body.startswith(NPY_MAGIC):
+        array = np.load(io.BytesIO(body), allow_pickle=False)
+        if array.ndim not in (2, 3) or input_nc != 1:
+            raise ValueError('NPY input must be a (H, W) slice or a (D, H, W) volume of single-channel slices')
+        volume = normalize_slices(array if array.ndim == 3 else array[None])
+        return list(torch.from_numpy(volume).unsqueeze(1)), 'npy', array.ndim
+    raise ValueError('Body must be a PNG image or an NPY array')
+
+
+def encode(outputs, kind, ndim):
+    """Generator outputs in [-1, 1] to response bytes, as [0, 1] intensities."""
+    buffer = io.BytesIO()
+    if kind == 'png':
+        save_image(0.5 * (outputs[0] + 1.0), buffer, format='png')
+    else:
+        volume = (0.5 * (torch.stack(outputs)[:, 0] + 1.0)).numpy().astype(np.float32)
+        np.save(buffer, volume if ndim == 3 else volume[0])
+    return buffer.getvalue()
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Set on the server: batchers {'A2B': DynamicBatcher, ...}, metrics, input_ncs, request_timeout
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, code, obj):
+        self._send(code, json.dumps(obj).encode(), 'application/json')
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/health':
+            self._send_json(200, {'status': 'ok', 'directions': sorted(server.batchers)})
+        elif self.path == '/metrics':
+            queue_depth = sum(len(batcher) for batcher in server.batchers.values())
+            self._send_json(200, server.metrics.snapshot(queue_depth))
+        else:
+            self._send_json(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        server = self.server
+        start = time.time()
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        direction = self.path.strip('/').split('/')[-1]
+        if not self.path.startswith('/translate/') or direction not in server.batchers:
+            self._send_json(404, {'error': 'POST to /translate/<%s>' % '|'.join(sorted(server.batchers))})
+            return
+        try:
+            slices, kind, ndim = decode(body, server.input_ncs[direction])
+        except Exception as e:
+            server.metrics.error()
+            self._send_json(400, {'error': str(e)})
+            return
+        try:
+            futures = server.batchers[direction].submit(slices)
+            outputs = [future.result(timeout=server.request_timeout) for future in futures]
+        except Exception as e:
+            server.metrics.error()
+            self._send_json(500, {'error': str(e)})
+            return
+        self._send(200, encode(outputs, kind, ndim), 'image/png' if kind == 'png' else 'application/x-npy')
+        server.metrics.request(time.time() - start, len(slices))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def load_generator(opt, checkpoint, exported, input_nc, output_nc, device):
+    if exported:
+        return load_exported(exported, device)
+    netG = build_generator(opt, input_nc, output_nc).to(device)
+    netG.load_state_dict(torch.load(checkpoint, map_location=device))
+    return netG.eval()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='interface to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--generator_A2B', type=str, default='output/netG_A2B.pth', help='A2B generator checkpoint file')
+    parser.add_argument('--generator_B2A', type=str, default=None, help='B2A generator checkpoint file (optional)')
+    parser.add_argument('--exported_A2B', type=str, default=None, help='exported A2B generator (.pt or .onnx)')
+    parser.add_argument('--exported_B2A', type=str, default=None, help='exported B2A generator (.pt or .onnx)')
+    parser.add_argument('--input_nc', type=int, default=1, help='number of channels of input data')
+    parser.add_argument('--output_nc', type=int, default=1, help='number of channels of output data')
+    parser.add_argument('--cuda', action='store_true', help='use GPU computation')
+    parser.add_argument('--max_batch', type=int, default=8, help='largest number of slices per generator call')
+    parser.add_argument('--max_wait_ms', type=float, default=10, help='longest a slice waits for its batch to fill')
+    parser.add_argument('--workers', type=int, default=1, help='inference threads per direction')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds a request may wait for its results')
+    parser.add_argument('--verbose', action='store_true', help='log every request')
+    add_generator_args(parser)
+    opt = parser.parse_args()
+    print(opt)
+
+    device = torch.device('cuda' if opt.cuda else 'cpu')
+    metrics = ServiceMetrics()
+    directions = {'A2B': (opt.generator_A2B, opt.exported_A2B, opt.input_nc, opt.output_nc),
+                  'B2A': (opt.generator_B2A, opt.exported_B2A, opt.output_nc, opt.input_nc)}
+    batchers, input_ncs = {}, {}
+    for name, (checkpoint, exported, input_nc, output_nc) in directions.items():
+        if checkpoint or exported:
+            netG = load_generator(opt, checkpoint, exported, input_nc, output_nc, device)
+            batchers[name] = DynamicBatcher(netG, opt.max_batch, opt.max_wait_ms, opt.workers, device, metrics)
+            input_ncs[name] = input_nc
+
+    server = ThreadingHTTPServer((opt.host, opt.port), Handler)
+    server.daemon_threads = True
+    server.batchers, server.metrics, server.input_ncs = batchers, metrics, input_ncs
+    server.request_timeout, server.verbose = opt.timeout, opt.verbose
+    print('Serving %s on http://%s:%d (POST /translate/<direction>, GET /metrics)' % (
+        ', '.join(sorted(batchers)), opt.host, opt.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for batcher in batchers.values():
+            batcher.close()
@@ -2,6 +2,7 @@ import argparse
 import shutil
 import sys
 import os
+import time
 
 import torchvision.transforms as transforms
 from torchvision.utils import save_image
@@ -10,8 +11,12 @@ from torch.autograd import Variable
 import torch
 from tqdm import tqdm
 
-from models import Generator
+from models import add_generator_args
+from models import build_generator
+from model_cost import cost_report, format_cost
 from datasets import ImageDataset
+from export import load_exported
+from tiling import tiled_forward
 
 def remove_and_create_dir(path):
     if os.path.exists(path):
@@ -27,30 +32,50 @@ if __name__ == '__main__':
     parser.add_argument('--size', type=int, default=256, help='size of the data (squared assumed)')
     parser.add_argument('--cuda', action='store_true', help='use GPU computation')
     parser.add_argument('--n_cpu', type=int, default=8, help='number of cpu threads to use during batch generation')
+    parser.add_argument('--packed', action='store_true', help='read slices from packs built by pack_dataset.py')
     parser.add_argument('--generator_A2B', type=str, default='output/netG_A2B.pth', help='A2B generator checkpoint file')
     parser.add_argument('--generator_B2A', type=str, default='output/netG_B2A.pth', help='B2A generator checkpoint file')
+    parser.add_argument('--exported_A2B', type=str, default=None,
+                        help='exported A2B generator (.pt or .onnx from export.py) to run instead of --generator_A2B')
+    parser.add_argument('--exported_B2A', type=str, default=None,
+                        help='exported B2A generator (.pt or .onnx from export.py) to run instead of --generator_B2A')
+    parser.add_argument('--tile_size', type=int, default=0,
+                        help='run the generator over tiles of this size when the whole image does not fit '
+                             '--max_memory_mb (0: whole image); tiles are normalized on their own statistics, '
+                             'so tiled output only approximates the whole-image output')
+    parser.add_argument('--tile_overlap', type=int, default=32, help='overlap between neighbouring tiles')
+    parser.add_argument('--max_memory_mb', type=int, default=1024, help='activation memory budget for tiled inference')
+    add_generator_args(parser)
     opt = parser.parse_args()
     print(opt)
+    if bool(opt.exported_A2B) != bool(opt.exported_B2A):
+        parser.error('--exported_A2B and --exported_B2A go together')
 
     if torch.cuda.is_available() and not opt.cuda:
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
 
     ###### Definition of variables ######
+    start = time.perf_counter()
     # Networks
-    netG_A2B = Generator(opt.input_nc, opt.output_nc)
-    netG_B2A = Generator(opt.output_nc, opt.input_nc)
-
-    if opt.cuda:
-        netG_A2B.cuda()
-        netG_B2A.cuda()
-
-    # Load state dicts
-    netG_A2B.load_state_dict(torch.load(opt.generator_A2B))
-    netG_B2A.load_state_dict(torch.load(opt.generator_B2A))
-
-    # Set model's test mode
-    netG_A2B.eval()
-    netG_B2A.eval()
+    if opt.exported_A2B:
+        netG_A2B = load_exported(opt.exported_A2B, 'cuda' if opt.cuda else 'cpu')
+        netG_B2A = load_exported(opt.exported_B2A, 'cuda' if opt.cuda else 'cpu')
+    else:
+        netG_A2B = build_generator(opt, opt.input_nc, opt.output_nc)
+        netG_B2A = build_generator(opt, opt.output_nc, opt.input_nc)
+
+        if opt.cuda:
+            netG_A2B.cuda()
+            netG_B2A.cuda()
+
+        # Load state dicts
+        netG_A2B.load_state_dict(torch.load(opt.generator_A2B))
+        netG_B2A.load_state_dict(torch.load(opt.generator_B2A))
+
+        # Set model's test mode
+        netG_A2B.eval()
+        netG_B2A.eval()
+    load_time = time.perf_counter() - start
 
     # Inputs & targets memory allocation
     Tensor = torch.cuda.FloatTensor if opt.cuda else torch.Tensor
@@ -60,7 +85,7 @@ if __name__ == '__main__':
     # Dataset loader
     transforms_ = [transforms.ToTensor(),
                    transforms.Normalize([0.5], [0.5])]
-    dataloader = DataLoader(ImageDataset(opt.dataroot, transforms_=transforms_, mode='test'),
+    dataloader = DataLoader(ImageDataset(opt.dataroot, transforms_=transforms_, mode='test', packed=opt.packed),
                             batch_size=opt.batchSize, shuffle=False, num_workers=opt.n_cpu)
     ###################################
 
@@ -72,21 +97,43 @@ if __name__ == '__main__':
 
     data_loader_test = tqdm(dataloader, file=sys.stdout)
     i = 0
+    steady_images = 0
+    cold_start = steady_start = None
     for batch in data_loader_test:
         i = i + 1
-        # Set model input
-        real_A = Variable(input_A.copy_(batch['A']))
-        real_B = Variable(input_B.copy_(batch['B']))
-
-        # Generate output
-        fake_B = 0.5 * (netG_A2B(real_A).data + 1.0)
-        fake_A = 0.5 * (netG_B2A(real_B).data + 1.0)
+        if opt.tile_size:
+            # Any resolution, bounded memory
+            real_A = batch['A'].type(Tensor)
+            real_B = batch['B'].type(Tensor)
+            fake_B = 0.5 * (tiled_forward(netG_A2B, real_A, opt.tile_size, opt.tile_overlap, opt.max_memory_mb) + 1.0)
+            fake_A = 0.5 * (tiled_forward(netG_B2A, real_B, opt.tile_size, opt.tile_overlap, opt.max_memory_mb) + 1.0)
+        else:
+            # Set model input
+            real_A = Variable(input_A.copy_(batch['A']))
+            real_B = Variable(input_B.copy_(batch['B']))
+
+            # Generate output
+            fake_B = 0.5 * (netG_A2B(real_A).data + 1.0)
+            fake_A = 0.5 * (netG_B2A(real_B).data + 1.0)
 
         # Save image files
         save_image(fake_A, 'output/A/%04d.png' % (i + 1))
         save_image(fake_B, 'output/B/%04d.png' % (i + 1))
 
         sys.stdout.write('\rGenerated images %04d of %04d' % (i + 1, len(dataloader)))
+        if i == 1:
+            # Model load and first batch, including any lazy initialization of the runtime
+            cold_start = time.perf_counter() - start
+            steady_start = time.perf_counter()
+        else:
+            steady_images += len(batch['A'])
 
     sys.stdout.write('\n')
+    if cold_start is not None:
+        print('Model load %.2fs | cold start %.2fs (load + first batch)' % (load_time, cold_start))
+    if steady_images:
+        print('Steady state %.2f images/s per direction' % (steady_images / (time.perf_counter() - steady_start)))
+    if not opt.exported_A2B:
+        cost = cost_report(netG_A2B, opt.input_nc, opt.size, device='cuda' if opt.cuda else 'cpu', runs=0)
+        print('Generator %s: %s per %dx%d image' % (opt.arch, format_cost(cost), opt.size, opt.size))
     ###################################
@@ -1,8 +1,8 @@
 import argparse
-import glob
 import os
 import shutil
 import sys
+import time
 
 import torch
 import torchvision.transforms as transforms
@@ -13,13 +13,18 @@ from torch.utils.data import Dataset
 from torchvision.utils import save_image
 from tqdm import tqdm
 
-from models import Generator
+from models import add_generator_args
+from models import build_generator
+from model_cost import cost_report, format_cost
+from tiling import tiled_forward
+from export import load_exported
+from datasets import list_images
 
 
 class ImageDataset(Dataset):
     def __init__(self, folder, transforms_=None):
         self.transform = transforms.Compose(transforms_)
-        self.files_A = sorted(glob.glob(os.path.join(folder, '*.*')))
+        self.files_A = list_images(folder)
 
     def __getitem__(self, index):
         item_A = self.transform(Image.open(self.files_A[index % len(self.files_A)]))
@@ -47,20 +52,34 @@ def test_a2b(input_path, output_path):
     parser.add_argument('--n_cpu', type=int, default=8, help='number of cpu threads to use during batch generation')
     parser.add_argument('--generator_A2B', type=str, default='output/netG_A2B.pth',
                         help='A2B generator checkpoint file')
+    parser.add_argument('--exported_A2B', type=str, default=None,
+                        help='exported A2B generator (.pt or .onnx from export.py) to run instead of --generator_A2B')
+    parser.add_argument('--tile_size', type=int, default=0,
+                        help='run the generator over tiles of this size when the whole image does not fit '
+                             '--max_memory_mb (0: whole image); tiles are normalized on their own statistics, '
+                             'so tiled output only approximates the whole-image output')
+    parser.add_argument('--tile_overlap', type=int, default=32, help='overlap between neighbouring tiles')
+    parser.add_argument('--max_memory_mb', type=int, default=1024, help='activation memory budget for tiled inference')
+    add_generator_args(parser)
     opt = parser.parse_args()
     print(opt)
 
     if torch.cuda.is_available() and not opt.cuda:
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
 
-    netG_A2B = Generator(opt.input_nc, opt.output_nc)
+    start = time.perf_counter()
+    if opt.exported_A2B:
+        netG_A2B = load_exported(opt.exported_A2B, 'cuda' if opt.cuda else 'cpu')
+    else:
+        netG_A2B = build_generator(opt, opt.input_nc, opt.output_nc)
 
-    if opt.cuda:
-        netG_A2B.cuda()
+        if opt.cuda:
+            netG_A2B.cuda()
 
-    netG_A2B.load_state_dict(torch.load(opt.generator_A2B))
+        netG_A2B.load_state_dict(torch.load(opt.generator_A2B))
 
-    netG_A2B.eval()
+        netG_A2B.eval()
+    load_time = time.perf_counter() - start
 
     Tensor = torch.cuda.FloatTensor if opt.cuda else torch.Tensor
     input_A = Tensor(opt.batchSize, opt.input_nc, opt.size, opt.size)
@@ -75,17 +94,36 @@ def test_a2b(input_path, output_path):
 
     data_loader_test = tqdm(dataloader, file=sys.stdout)
     i = 0
+    steady_images = 0
+    cold_start = steady_start = None
     for batch in data_loader_test:
         i = i + 1
-        real_A = Variable(input_A.copy_(batch['A']))
+        if opt.tile_size:
+            real_A = batch['A'].type(Tensor)
+            fake_B = 0.5 * (tiled_forward(netG_A2B, real_A, opt.tile_size, opt.tile_overlap, opt.max_memory_mb) + 1.0)
+        else:
+            real_A = Variable(input_A.copy_(batch['A']))
 
-        fake_B = 0.5 * (netG_A2B(real_A).data + 1.0)
+            fake_B = 0.5 * (netG_A2B(real_A).data + 1.0)
 
         save_image(fake_B, os.path.join(output_path,  f"{i:04d}.png"))
 
         sys.stdout.write('\rGenerated images %04d of %04d' % (i + 1, len(dataloader)))
+        if i == 1:
+            # Model load and first batch, including any lazy initialization of the runtime
+            cold_start = time.perf_counter() - start
+            steady_start = time.perf_counter()
+        else:
+            steady_images += len(batch['A'])
 
     sys.stdout.write('\n')
+    if cold_start is not None:
+        print('Model load %.2fs | cold start %.2fs (load + first batch)' % (load_time, cold_start))
+    if steady_images:
+        print('Steady state %.2f images/s' % (steady_images / (time.perf_counter() - steady_start)))
+    if not opt.exported_A2B:
+        cost = cost_report(netG_A2B, opt.input_nc, opt.size, device='cuda' if opt.cuda else 'cpu', runs=0)
+        print('Generator %s: %s per %dx%d image' % (opt.arch, format_cost(cost), opt.size, opt.size))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,90 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+# Rough count of live fp32 activations per input pixel for each base channel of the generator
+# (full resolution stem/head dominate: padded input, conv output and norm output side by side)
+ACTIVATIONS_PER_CHANNEL = 4
+
+
+def _base_channels(netG):
+    if not isinstance(netG, nn.Module):
+        # Exported runtimes; assume the default width
+        return 64
+    for m in netG.modules():
+        if isinstance(m, nn.Conv2d):
+            return m.out_channels
+    return 64
+
+
+def tile_memory(netG, tile_size):
+    """Estimated peak bytes of one tile going through `netG` without autograd."""
+    return tile_size * tile_size * _base_channels(netG) * ACTIVATIONS_PER_CHANNEL * 4
+
+
+def _window(tile_size, overlap, device):
+    ramp = torch.ones(tile_size, device=device)
+    if overlap > 0:
+        edge = (torch.arange(overlap, dtype=torch.float32, device=device) + 0.5) / overlap
+        ramp[:overlap] = edge
+        ramp[-overlap:] = edge.flip(0)
+    return ramp[:, None] * ramp[None, :]
+
+
+def _starts(length, tile_size, stride):
+    starts = list(range(0, length - tile_size, stride))
+    return starts + [length - tile_size]
+
+
+def tiled_forward(netG, image, tile_size=256, overlap=32, max_memory_mb=1024):
+    """Run `netG` over an (N, C, H, W) image of any size in overlapping tiles.
+
+    Tiles are blended with a linear ramp over the overlap, so seams average out. As many tiles
+    as fit in `max_memory_mb` (see `tile_memory`) go through the generator per call.
+
+    Tiled output only approximates the whole-image output, not just at the seams: every
+    InstanceNorm normalizes a tile on that tile's own statistics, so a tile that is mostly air
+    comes out differently from its neighbours, and the generator sees further than the overlap.
+    Images that fit the budget whole are therefore not tiled, which gives the exact output.
+    """
+    assert tile_size % 4 == 0, 'Tile size must be divisible by 4 (two stride-2 downsamplings)'
+    assert 0 <= 2 * overlap < tile_size, 'Overlap must be less than half the tile size'
+    n, _, height, width = image.size()
+
+    max_pixels = int(max_memory_mb * 2 ** 20 // tile_memory(netG, 1))
+    if height * width <= max_pixels:
+        per_call = max(1, max_pixels // (height * width))
+        with torch.no_grad():
+            return torch.cat([netG(image[start:start + per_call]) for start in range(0, n, per_call)])
+
+    # Images smaller than a tile are padded up to it and cropped back at the end
+    pad_h, pad_w = max(tile_size - height, 0), max(tile_size - width, 0)
+    if pad_h or pad_w:
+        mode = 'reflect' if pad_h < height and pad_w < width else 'replicate'
+        image = F.pad(image, (0, pad_w, 0, pad_h), mode=mode)
+    padded_h, padded_w = image.size()[2:]
+
+    stride = tile_size - overlap
+    rows = _starts(padded_h, tile_size, stride)
+    cols = _starts(padded_w, tile_size, stride)
+    positions = [(i, y, x) for i in range(n) for y in rows for x in cols]
+    batch_tiles = max(1, int(max_memory_mb * 2 ** 20 // tile_memory(netG, tile_size)))
+
+    window = _window(tile_size, overlap, image.device)
+    weight = torch.zeros(padded_h, padded_w, device=image.device)
+    for y in rows:
+        for x in cols:
+            weight[y:y + tile_size, x:x + tile_size] += window
+
+    output = None
+    with torch.no_grad():
+        for start in range(0, len(positions), batch_tiles):
+            chunk = positions[start:start + batch_tiles]
+            tiles = torch.stack([image[i, :, y:y + tile_size, x:x + tile_size] for i, y, x in chunk])
+            result = netG(tiles)
+            if output is None:
+                output = torch.zeros(n, result.size(1), padded_h, padded_w, device=image.device)
+            for (i, y, x), tile in zip(chunk, result):
+                output[i, :, y:y + tile_size, x:x + tile_size] += tile * window
+
+    return (output / weight)[:, :, :height, :width]
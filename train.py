@@ -1,74 +1,338 @@
 #!/usr/bin/python3
 
 import argparse
+import contextlib
 import itertools
+import os
+import random
 import sys
 
 import numpy as np
 import torchvision.transforms as transforms
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import DataLoader
-from torch.autograd import Variable
 from PIL import Image
 import torch
 from tqdm import tqdm
 
-from models import Generator
 from models import Discriminator
+from models import add_generator_args
+from models import build_generator
+from model_cost import cost_report, format_cost
 from utils import ReplayBuffer
 from utils import LambdaLR
 from utils import Logger
+from utils import MetricsSink
 from utils import weights_init_normal
-from datasets import ImageDataset
+from datasets import ImageDataset, PairSampler, mix_seed
+from augment import AugmentCollate, BatchAugment, load_transforms
+from checkpoint import CheckpointManager, atomic_save, rng_state, set_rng_state
+from profiler import StepProfiler
+
+# Lossess
+criterion_GAN = torch.nn.MSELoss()
+criterion_cycle = torch.nn.L1Loss()
+criterion_identity = torch.nn.L1Loss()
+
+DISABLED = StepProfiler()
+
+
+def autocast(device_type, amp='fp32'):
+    if amp == 'fp32':
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16 if amp == 'bf16' else torch.float16)
+
+
+def unwrap(net):
+    return net.module if isinstance(net, DistributedDataParallel) else net
+
+
+def discriminator_outputs(netD, real, fake, fused=False):
+    """Discriminator predictions on real and (detached) fake images.
+
+    Fused, both go through the network in one concatenated batch. The Discriminator only uses
+    InstanceNorm, so samples do not interact and the split outputs match two separate calls.
+    """
+    if fused:
+        return netD(torch.cat([real, fake.detach()])).float().split([len(real), len(fake)])
+    return netD(real).float(), netD(fake.detach()).float()
+
+
+def generator_outputs(netG, real, same, fused=False):
+    """Translation of `real` and identity mapping of `same` (an image already in the target domain).
+
+    Fused, both go through the generator in one concatenated batch; like the Discriminator, the
+    Generator only uses InstanceNorm, so the split outputs match two separate calls.
+    """
+    if fused:
+        return netG(torch.cat([real, same])).split([len(real), len(same)])
+    return netG(real), netG(same)
+
+
+def no_sync(nets, enabled=True):
+    """Skip the DDP gradient all-reduce of `nets` for the micro-batches before the last one."""
+    stack = contextlib.ExitStack()
+    if enabled:
+        for net in nets:
+            if isinstance(net, DistributedDataParallel):
+                stack.enter_context(net.no_sync())
+    return stack
+
+
+def generator_losses(nets, real_A, real_B, fused_g=False):
+    """Identity, GAN and cycle losses of both generators, plus the translated images."""
+    netG_A2B, netG_B2A, netD_A, netD_B = nets
+    fake_B, same_B = generator_outputs(netG_A2B, real_A, real_B, fused_g)
+    fake_A, same_A = generator_outputs(netG_B2A, real_B, real_A, fused_g)
+
+    # Identity loss
+    # G_A2B(B) should equal B if real B is fed
+    loss_identity_B = criterion_identity(same_B.float(), real_B) * 5.0
+    # G_B2A(A) should equal A if real A is fed
+    loss_identity_A = criterion_identity(same_A.float(), real_A) * 5.0
+
+    # GAN loss
+    # The discriminators' gradients from this loss are thrown away, so they bypass the DDP all-reduce
+    pred_fake = unwrap(netD_B)(fake_B).float()
+    loss_GAN_A2B = criterion_GAN(pred_fake, torch.ones_like(pred_fake))
+
+    pred_fake = unwrap(netD_A)(fake_A).float()
+    loss_GAN_B2A = criterion_GAN(pred_fake, torch.ones_like(pred_fake))
+
+    # Cycle loss
+    recovered_A = netG_B2A(fake_B)
+    loss_cycle_ABA = criterion_cycle(recovered_A.float(), real_A) * 10.0
+
+    recovered_B = netG_A2B(fake_A)
+    loss_cycle_BAB = criterion_cycle(recovered_B.float(), real_B) * 10.0
+
+    # Total loss
+    loss_G = loss_identity_A + loss_identity_B + loss_GAN_A2B + loss_GAN_B2A + loss_cycle_ABA + loss_cycle_BAB
+
+    losses = {'loss_G': loss_G, 'loss_G_identity': (loss_identity_A + loss_identity_B),
+              'loss_G_GAN': (loss_GAN_A2B + loss_GAN_B2A), 'loss_G_cycle': (loss_cycle_ABA + loss_cycle_BAB)}
+    return losses, fake_A, fake_B
+
+
+def discriminator_step(netD, optimizer, scaler, reals, fakes, weights, precision, fused_d=False):
+    """Accumulate the discriminator loss over micro-batches, then update; returns the batch loss."""
+    optimizer.zero_grad()
+    loss_D = 0.0
+    for k, (real, fake, weight) in enumerate(zip(reals, fakes, weights)):
+        with no_sync([netD], k < len(reals) - 1):
+            with precision:
+                pred_real, pred_fake = discriminator_outputs(netD, real, fake, fused_d)
+
+                # Real loss
+                loss_D_real = criterion_GAN(pred_real, torch.ones_like(pred_real))
+
+                # Fake loss
+                loss_D_fake = criterion_GAN(pred_fake, torch.zeros_like(pred_fake))
+
+                # Total loss
+                loss = (loss_D_real + loss_D_fake) * 0.5 * weight
+            scaler.scale(loss).backward()
+        loss_D = loss_D + loss.detach()
+
+    scaler.step(optimizer)
+    return loss_D
+
+
+def train_step(nets, optimizers, buffers, real_A, real_B, amp='fp32', scaler=None, profiler=DISABLED,
+               fused_d=False, fused_g=False, accum_steps=1):
+    """One generator update followed by both discriminator updates.
+
+    Under autocast, convolutions run in reduced precision while the losses are computed on fp32
+    copies of the outputs; InstanceNorm lowers to batch_norm, which keeps its statistics in fp32.
+    With fp16 a single GradScaler covers the three optimizers and is updated once per step.
+    Networks may be wrapped in DistributedDataParallel. `fused_d` runs real and fake images
+    through each discriminator in a single call; `fused_g` does the same for the translation and
+    identity inputs of each generator.
+    With `accum_steps` > 1 the batch is split into that many micro-batches whose gradients are
+    accumulated, each loss weighted by its share of the batch, before every optimizer steps once;
+    only the last micro-batch all-reduces under DDP. Since no network mixes samples, the update
+    matches the one from the whole batch.
+    Phases are timed by `profiler` when it is enabled.
+    """
+    netG_A2B, netG_B2A, netD_A, netD_B = nets
+    optimizer_G, optimizer_D_A, optimizer_D_B = optimizers
+    fake_A_buffer, fake_B_buffer = buffers
+    if scaler is None:
+        scaler = torch.amp.GradScaler(real_A.device.type, enabled=False)
+    precision = autocast(real_A.device.type, amp)
+    reals_A, reals_B = real_A.chunk(accum_steps), real_B.chunk(accum_steps)
+    weights = [len(chunk) / len(real_A) for chunk in reals_A]
+
+    ###### Generators A2B and B2A ######
+    optimizer_G.zero_grad()
+    # The discriminators only pass gradients through to the generators here
+    netD_A.requires_grad_(False)
+    netD_B.requires_grad_(False)
+
+    losses, fakes_A, fakes_B = {}, [], []
+    for k, (micro_A, micro_B, weight) in enumerate(zip(reals_A, reals_B, weights)):
+        with no_sync((netG_A2B, netG_B2A), k < len(reals_A) - 1):
+            with profiler.phase('G_forward'), precision:
+                micro_losses, fake_A, fake_B = generator_losses(nets, micro_A, micro_B, fused_g)
+
+            with profiler.phase('G_backward'):
+                scaler.scale(micro_losses['loss_G'] * weight).backward()
+        for name, loss in micro_losses.items():
+            losses[name] = losses.get(name, 0.0) + loss.detach() * weight
+        fakes_A.append(fake_A.detach())
+        fakes_B.append(fake_B.detach())
+
+    with profiler.phase('G_backward'):
+        scaler.step(optimizer_G)
+    netD_A.requires_grad_(True)
+    netD_B.requires_grad_(True)
+    ###################################
+
+    with profiler.phase('replay_buffer'):
+        fake_A = fake_A_buffer.push_and_pop(torch.cat(fakes_A))
+        fake_B = fake_B_buffer.push_and_pop(torch.cat(fakes_B))
+
+    ###### Discriminator A ######
+    with profiler.phase('D_A'):
+        loss_D_A = discriminator_step(netD_A, optimizer_D_A, scaler, reals_A, fake_A.chunk(accum_steps), weights,
+                                      precision, fused_d)
+    ###################################
+
+    ###### Discriminator B ######
+    with profiler.phase('D_B'):
+        loss_D_B = discriminator_step(netD_B, optimizer_D_B, scaler, reals_B, fake_B.chunk(accum_steps), weights,
+                                      precision, fused_d)
+    scaler.update()
+    ###################################
+
+    losses['loss_D'] = loss_D_A + loss_D_B
+    images = {'real_A': real_A, 'real_B': real_B, 'fake_A': fake_A, 'fake_B': fake_B}
+    return losses, images
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--epoch', type=int, default=1, help='starting epoch')
     parser.add_argument('--n_epochs', type=int, default=200, help='number of epochs of training')
-    parser.add_argument('--batchSize', type=int, default=1, help='size of the batches')
+    parser.add_argument('--batchSize', type=int, default=1, help='size of the (micro-)batches')
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help='micro-batches accumulated per optimizer step (effective batch: batchSize * accum_steps)')
     parser.add_argument('--dataroot', type=str, default='datasets/cbct2ct/', help='root directory of the dataset')
     parser.add_argument('--lr', type=float, default=0.0002, help='initial learning rate')
     parser.add_argument('--decay_epoch', type=int, default=100, help='epoch to start linearly decaying the learning rate to 0')
     parser.add_argument('--size', type=int, default=256, help='size of the data crop (squared assumed)')
     parser.add_argument('--input_nc', type=int, default=1, help='number of channels of input data')
     parser.add_argument('--output_nc', type=int, default=1, help='number of channels of output data')
-    parser.add_argument('--cuda', action='store_true', default=True, help='use GPU computation')
+    parser.add_argument('--cuda', action='store_true', help='use GPU computation')
     parser.add_argument('--n_cpu', type=int, default=8, help='number of cpu threads to use during batch generation')
+    parser.add_argument('--amp', type=str, default='fp32', choices=['fp32', 'bf16', 'fp16'],
+                        help='mixed precision: bf16 autocast (CPU/GPU) or fp16 autocast with gradient scaling (GPU)')
+    parser.add_argument('--fused_d', action='store_true',
+                        help='one discriminator call over concatenated real and fake batches')
+    parser.add_argument('--fused_g', action='store_true',
+                        help='one generator call over concatenated translation and identity batches')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='run networks and inputs in channels_last memory format')
+    parser.add_argument('--packed', action='store_true', help='read slices from packs built by pack_dataset.py')
+    parser.add_argument('--augment', type=str, default='sample', choices=['sample', 'worker', 'device'],
+                        help='crop and flip per sample with PIL, or per collated batch in the workers or on the device')
+    parser.add_argument('--cache', action='store_true',
+                        help='resize the training slices once into a cache under <dataroot>/.cache')
+    parser.add_argument('--distributed', action='store_true',
+                        help='data-parallel training, one process per device (launch with torchrun)')
+    parser.add_argument('--backend', type=str, default=None, choices=['gloo', 'nccl'],
+                        help='torch.distributed backend (default: nccl with --cuda, gloo otherwise)')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for reproducible runs')
     parser.add_argument('--resume', action='store_true', default=False, help='resume from previous checkpoint')
+    parser.add_argument('--checkpoint_dir', type=str, default='output/checkpoints', help='directory of full training-state checkpoints')
+    parser.add_argument('--checkpoint_every', type=int, default=1000, help='save the training state every N steps (0 to disable)')
+    parser.add_argument('--keep_last', type=int, default=3, help='number of training-state checkpoints to keep')
+    parser.add_argument('--log_every', type=int, default=10, help='reduce and print losses every N batches')
+    parser.add_argument('--metrics_file', type=str, default='output/metrics.jsonl',
+                        help='append-only metrics log (.jsonl or .csv, empty to disable)')
+    parser.add_argument('--no_visdom', action='store_true', help='train headless without a Visdom server')
+    parser.add_argument('--profile', action='store_true', help='time each phase of the training step')
+    parser.add_argument('--profile_sync', action='store_true', help='synchronize CUDA around phases for exact timing')
+    parser.add_argument('--profile_trace', type=int, nargs=2, default=None, metavar=('START', 'STEPS'),
+                        help='record a torch.profiler trace of steps START..START+STEPS-1 (counting from 1)')
+    add_generator_args(parser)
     opt = parser.parse_args()
-    print(opt)
 
-    if torch.cuda.is_available() and not opt.cuda:
+    rank, world_size, local_rank = 0, 1, 0
+    if opt.distributed:
+        # torchrun sets RANK, WORLD_SIZE, LOCAL_RANK and the rendezvous address
+        rank = int(os.environ['RANK'])
+        world_size = int(os.environ['WORLD_SIZE'])
+        local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        torch.distributed.init_process_group(backend=opt.backend or ('nccl' if opt.cuda else 'gloo'))
+        if opt.cuda:
+            torch.cuda.set_device(local_rank)
+        else:
+            # Share the cores between the processes on this node instead of oversubscribing them
+            local_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_size))
+    main_process = rank == 0
+    device = torch.device('cuda', local_rank) if opt.cuda else torch.device('cpu')
+
+    if main_process:
+        print(opt)
+
+    if torch.cuda.is_available() and not opt.cuda and main_process:
         print("WARNING: You have a CUDA device, so you should probably run with --cuda")
 
+    if opt.seed is not None:
+        # Per-rank streams; DDP copies rank 0's initial weights to every rank
+        random.seed(opt.seed + rank)
+        np.random.seed(opt.seed + rank)
+        torch.manual_seed(opt.seed + rank)
+
     ###### Definition of variables ######
     # Networks
-    netG_A2B = Generator(opt.input_nc, opt.output_nc)
-    netG_B2A = Generator(opt.output_nc, opt.input_nc)
+    netG_A2B = build_generator(opt, opt.input_nc, opt.output_nc)
+    netG_B2A = build_generator(opt, opt.output_nc, opt.input_nc)
     netD_A = Discriminator(opt.input_nc)
     netD_B = Discriminator(opt.output_nc)
 
-    if opt.cuda:
-        netG_A2B.cuda()
-        netG_B2A.cuda()
-        netD_A.cuda()
-        netD_B.cuda()
+    netG_A2B.to(device)
+    netG_B2A.to(device)
+    netD_A.to(device)
+    netD_B.to(device)
 
     netG_A2B.apply(weights_init_normal)
     netG_B2A.apply(weights_init_normal)
     netD_A.apply(weights_init_normal)
     netD_B.apply(weights_init_normal)
 
-    if opt.resume:
-        # Load state dicts
-        netG_A2B.load_state_dict(torch.load('output/netG_A2B.pth'))
-        netG_B2A.load_state_dict(torch.load('output/netG_B2A.pth'))
-        netD_A.load_state_dict(torch.load('output/netD_A.pth'))
-        netD_B.load_state_dict(torch.load('output/netD_B.pth'))
+    # After initialization, which fills weights in memory order
+    memory_format = torch.channels_last if opt.channels_last else torch.preserve_format
+    for net in (netG_A2B, netG_B2A, netD_A, netD_B):
+        net.to(memory_format=memory_format)
+
+    if main_process:
+        cost = cost_report(netG_A2B, opt.input_nc, opt.size, device=device, runs=0)
+        print('Generator %s: %s per %dx%d image' % (opt.arch, format_cost(cost), opt.size, opt.size))
 
-    # Lossess
-    criterion_GAN = torch.nn.MSELoss()
-    criterion_cycle = torch.nn.L1Loss()
-    criterion_identity = torch.nn.L1Loss()
+    checkpoints = CheckpointManager(opt.checkpoint_dir, keep_last=opt.keep_last)
+    state = None
+    if opt.resume:
+        if checkpoints.latest() is not None:
+            # Full training state, restored below once everything is built
+            state = checkpoints.load()
+            if main_process:
+                print('Resuming from %s' % checkpoints.latest())
+        else:
+            # Load state dicts
+            netG_A2B.load_state_dict(torch.load('output/netG_A2B.pth', map_location=device))
+            netG_B2A.load_state_dict(torch.load('output/netG_B2A.pth', map_location=device))
+            netD_A.load_state_dict(torch.load('output/netD_A.pth', map_location=device))
+            netD_B.load_state_dict(torch.load('output/netD_B.pth', map_location=device))
+    seed = state['seed'] if state is not None else opt.seed if opt.seed is not None else random.randrange(2 ** 31)
+    if opt.distributed and state is None:
+        # Every rank must shuffle with the same seed
+        seed = torch.tensor(seed, device=device)
+        torch.distributed.broadcast(seed, 0)
+        seed = seed.item()
+    lr_offset = state['lr_offset'] if state is not None else opt.epoch
 
     # Optimizers & LR schedulers
     optimizer_G = torch.optim.Adam(itertools.chain(netG_A2B.parameters(), netG_B2A.parameters()),
@@ -76,29 +340,14 @@ if __name__ == '__main__':
     optimizer_D_A = torch.optim.Adam(netD_A.parameters(), lr=opt.lr, betas=(0.5, 0.999))
     optimizer_D_B = torch.optim.Adam(netD_B.parameters(), lr=opt.lr, betas=(0.5, 0.999))
 
-    lr_scheduler_G = torch.optim.lr_scheduler.LambdaLR(optimizer_G, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch,
+    lr_scheduler_G = torch.optim.lr_scheduler.LambdaLR(optimizer_G, lr_lambda=LambdaLR(opt.n_epochs, lr_offset,
                                                                                        opt.decay_epoch).step)
-    lr_scheduler_D_A = torch.optim.lr_scheduler.LambdaLR(optimizer_D_A, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch,
+    lr_scheduler_D_A = torch.optim.lr_scheduler.LambdaLR(optimizer_D_A, lr_lambda=LambdaLR(opt.n_epochs, lr_offset,
                                                                                            opt.decay_epoch).step)
-    lr_scheduler_D_B = torch.optim.lr_scheduler.LambdaLR(optimizer_D_B, lr_lambda=LambdaLR(opt.n_epochs, opt.epoch,
+    lr_scheduler_D_B = torch.optim.lr_scheduler.LambdaLR(optimizer_D_B, lr_lambda=LambdaLR(opt.n_epochs, lr_offset,
                                                                                            opt.decay_epoch).step)
 
-    # Inputs & targets memory allocation
-    # Tensor = torch.cuda.FloatTensor if opt.cuda else torch.Tensor
-    # input_A = Tensor(opt.batchSize, opt.input_nc, opt.size, opt.size)
-    # input_B = Tensor(opt.batchSize, opt.output_nc, opt.size, opt.size)
-    # target_real = Variable(Tensor(opt.batchSize).fill_(1.0), requires_grad=False)
-    # target_fake = Variable(Tensor(opt.batchSize).fill_(0.0), requires_grad=False)
-
-    # 为输入和目标张量分配内存
-    device = torch.device('cuda' if opt.cuda else 'cpu')
-
-    input_A = torch.zeros(opt.batchSize, opt.input_nc, opt.size, opt.size, device=device, dtype=torch.float32)
-    input_B = torch.zeros(opt.batchSize, opt.output_nc, opt.size, opt.size, device=device, dtype=torch.float32)
-
-    # 为目标张量分配并初始化
-    target_real = torch.full((opt.batchSize,), 1.0, device=device, dtype=torch.float32)
-    target_fake = torch.full((opt.batchSize,), 0.0, device=device, dtype=torch.float32)
+    scaler = torch.amp.GradScaler(device.type, enabled=opt.amp == 'fp16')
 
     fake_A_buffer = ReplayBuffer()
     fake_B_buffer = ReplayBuffer()
@@ -109,102 +358,115 @@ if __name__ == '__main__':
                    transforms.RandomHorizontalFlip(),
                    transforms.ToTensor(),
                    transforms.Normalize([0.5], [0.5])]
-    dataloader = DataLoader(ImageDataset(opt.dataroot, transforms_=transforms_, unaligned=True),
-                            batch_size=opt.batchSize, shuffle=True, num_workers=opt.n_cpu)
-
-    # Loss plot
-    logger = Logger(opt.n_epochs, len(dataloader))
+    collate_fn, device_augment = None, None
+    if opt.augment != 'sample':
+        # Samples come out as fixed-size tensors; crop, flip and normalization run on whole batches
+        transforms_ = load_transforms(int(opt.size * 1.12))
+        if opt.augment == 'worker':
+            collate_fn = AugmentCollate(BatchAugment(opt.size))
+        else:
+            device_augment = BatchAugment(opt.size)
+    if opt.distributed and opt.cache and not main_process:
+        # Rank 0 builds the resize cache, the other ranks then open it
+        torch.distributed.barrier()
+    dataset = ImageDataset(opt.dataroot, transforms_=transforms_, unaligned=True, packed=opt.packed,
+                           cache=opt.cache)
+    if opt.distributed and opt.cache and main_process:
+        torch.distributed.barrier()
+    # Each rank trains on its own shard of A; unaligned B images are still drawn from the whole of B
+    sampler = PairSampler(dataset, seed=seed, unaligned=True, num_replicas=world_size, rank=rank)
+    loader_generator = torch.Generator()
+    # One loader batch per optimizer step, split into micro-batches by train_step
+    dataloader = DataLoader(dataset, batch_size=opt.batchSize * opt.accum_steps, sampler=sampler,
+                            num_workers=opt.n_cpu, generator=loader_generator, collate_fn=collate_fn)
+
+    # Loss plot (rank 0 reports its own losses)
+    sink = MetricsSink(opt.metrics_file) if opt.metrics_file and main_process else None
+    logger = Logger(opt.n_epochs, len(dataloader), log_every=opt.log_every,
+                    visdom=not opt.no_visdom and main_process, sink=sink, verbose=main_process)
+    profiler = StepProfiler(enabled=opt.profile or opt.profile_trace is not None, sync=opt.profile_sync,
+                            trace_start=opt.profile_trace[0] if opt.profile_trace else None,
+                            trace_steps=opt.profile_trace[1] if opt.profile_trace else 0)
+
+    # Everything a step-level resume needs
+    stateful = {'netG_A2B': netG_A2B, 'netG_B2A': netG_B2A, 'netD_A': netD_A, 'netD_B': netD_B,
+                'optimizer_G': optimizer_G, 'optimizer_D_A': optimizer_D_A, 'optimizer_D_B': optimizer_D_B,
+                'lr_scheduler_G': lr_scheduler_G, 'lr_scheduler_D_A': lr_scheduler_D_A,
+                'lr_scheduler_D_B': lr_scheduler_D_B, 'fake_A_buffer': fake_A_buffer, 'fake_B_buffer': fake_B_buffer,
+                'logger': logger}
+    if scaler.is_enabled():
+        stateful['scaler'] = scaler
+    # Replay buffers and RNG streams differ between ranks
+    local = {'fake_A_buffer': fake_A_buffer, 'fake_B_buffer': fake_B_buffer}
+    start_epoch, skip_batches, global_step = opt.epoch, 0, 0
+    if state is not None:
+        if len(state.get('ranks') or ()) == world_size:
+            state.update(state['ranks'][rank])
+        for name, obj in stateful.items():
+            if name in state:
+                obj.load_state_dict(state[name])
+        start_epoch, skip_batches, global_step = state['epoch'], state['batch'], state['step']
+        sampler.load_state_dict(state.get('sampler') or
+                                {'seed': seed, 'epoch': start_epoch, 'start': skip_batches * dataloader.batch_size})
+
+    nets = (netG_A2B, netG_B2A, netD_A, netD_B)
+    if opt.distributed:
+        # Wrapped after loading, since DDP broadcasts rank 0's weights
+        nets = tuple(DistributedDataParallel(net, device_ids=[local_rank] if opt.cuda else None) for net in nets)
     ###################################
 
     ###### Training ######
-    for epoch in range(opt.epoch, opt.n_epochs + 1):
-        data_loader_train = tqdm(dataloader, file=sys.stdout)
-        train_losses = []
-        # for i, batch in enumerate(dataloader):
-        for batch in data_loader_train:
-            # Set model input
-            real_A = Variable(input_A.copy_(batch['A']))
-            real_B = Variable(input_B.copy_(batch['B']))
-
-            ###### Generators A2B and B2A ######
-            optimizer_G.zero_grad()
-
-            # Identity loss
-            # G_A2B(B) should equal B if real B is fed
-            same_B = netG_A2B(real_B)
-            loss_identity_B = criterion_identity(same_B, real_B) * 5.0
-            # G_B2A(A) should equal A if real A is fed
-            same_A = netG_B2A(real_A)
-            loss_identity_A = criterion_identity(same_A, real_A) * 5.0
-
-            # GAN loss
-            fake_B = netG_A2B(real_A)
-            pred_fake = netD_B(fake_B)
-            loss_GAN_A2B = criterion_GAN(pred_fake, target_real)
-
-            fake_A = netG_B2A(real_B)
-            pred_fake = netD_A(fake_A)
-            loss_GAN_B2A = criterion_GAN(pred_fake, target_real)
-
-            # Cycle loss
-            recovered_A = netG_B2A(fake_B)
-            loss_cycle_ABA = criterion_cycle(recovered_A, real_A) * 10.0
-
-            recovered_B = netG_A2B(fake_A)
-            loss_cycle_BAB = criterion_cycle(recovered_B, real_B) * 10.0
-
-            # Total loss
-            loss_G = loss_identity_A + loss_identity_B + loss_GAN_A2B + loss_GAN_B2A + loss_cycle_ABA + loss_cycle_BAB
-            loss_G.backward()
-
-            train_losses.append(loss_G.item())
-            data_loader_train.desc = f"[train epoch {epoch}] loss: {np.mean(train_losses):.4f} "
+    for epoch in range(start_epoch, opt.n_epochs + 1):
+        # Same pairing, transform seeds and worker seeds whenever this epoch is replayed
+        sampler.set_epoch(epoch)
+        loader_generator.manual_seed(mix_seed(seed, epoch, rank))
+        if skip_batches:
+            # The sampler starts after the batches trained on before the checkpoint, without loading them
+            set_rng_state(state['rng'])
+        data_loader_train = tqdm(dataloader, file=sys.stdout, disable=not main_process, initial=skip_batches,
+                                 total=len(dataloader))
+        for i, batch in enumerate(data_loader_train, start=skip_batches):
+            profiler.lap('data')
 
-            optimizer_G.step()
-            ###################################
-
-            ###### Discriminator A ######
-            optimizer_D_A.zero_grad()
-
-            # Real loss
-            pred_real = netD_A(real_A)
-            loss_D_real = criterion_GAN(pred_real, target_real)
-
-            # Fake loss
-            fake_A = fake_A_buffer.push_and_pop(fake_A)
-            pred_fake = netD_A(fake_A.detach())
-            loss_D_fake = criterion_GAN(pred_fake, target_fake)
-
-            # Total loss
-            loss_D_A = (loss_D_real + loss_D_fake) * 0.5
-            loss_D_A.backward()
-
-            optimizer_D_A.step()
-            ###################################
-
-            ###### Discriminator B ######
-            optimizer_D_B.zero_grad()
-
-            # Real loss
-            pred_real = netD_B(real_B)
-            loss_D_real = criterion_GAN(pred_real, target_real)
-
-            # Fake loss
-            fake_B = fake_B_buffer.push_and_pop(fake_B)
-            pred_fake = netD_B(fake_B.detach())
-            loss_D_fake = criterion_GAN(pred_fake, target_fake)
-
-            # Total loss
-            loss_D_B = (loss_D_real + loss_D_fake) * 0.5
-            loss_D_B.backward()
-
-            optimizer_D_B.step()
-            ###################################
+            # Set model input
+            with profiler.phase('to_device'):
+                real_A = batch['A'].to(device, non_blocking=True, memory_format=memory_format)
+                real_B = batch['B'].to(device, non_blocking=True, memory_format=memory_format)
+            if device_augment is not None:
+                with profiler.phase('augment'):
+                    real_A = device_augment(real_A).to(memory_format=memory_format)
+                    real_B = device_augment(real_B).to(memory_format=memory_format)
+
+            losses, images = train_step(nets, (optimizer_G, optimizer_D_A, optimizer_D_B),
+                                        (fake_A_buffer, fake_B_buffer), real_A, real_B, amp=opt.amp, scaler=scaler,
+                                        profiler=profiler, fused_d=opt.fused_d, fused_g=opt.fused_g,
+                                        accum_steps=opt.accum_steps)
 
             # # Progress report (http://localhost:8097)
-            logger.log({'loss_G': loss_G, 'loss_G_identity': (loss_identity_A + loss_identity_B), 'loss_G_GAN': (loss_GAN_A2B + loss_GAN_B2A),
-                        'loss_G_cycle': (loss_cycle_ABA + loss_cycle_BAB), 'loss_D': (loss_D_A + loss_D_B)},
-                        images={'real_A': real_A, 'real_B': real_B, 'fake_A': fake_A, 'fake_B': fake_B})
+            with profiler.phase('logger'):
+                logger.log(losses, images=images)
+                if 'loss_G' in logger.means:
+                    data_loader_train.desc = f"[train epoch {epoch}] loss: {logger.means['loss_G']:.4f} "
+
+            global_step += 1
+            if opt.checkpoint_every and global_step % opt.checkpoint_every == 0:
+                with profiler.phase('checkpoint'):
+                    ranks = None
+                    if opt.distributed:
+                        local_state = {name: obj.state_dict() for name, obj in local.items()}
+                        local_state['rng'] = rng_state()
+                        ranks = [None] * world_size if main_process else None
+                        torch.distributed.gather_object(local_state, ranks, dst=0)
+                    if main_process:
+                        training_state = {name: obj.state_dict() for name, obj in stateful.items()}
+                        training_state.update(epoch=epoch, batch=i + 1, step=global_step, seed=seed,
+                                              lr_offset=lr_offset, rng=rng_state(), ranks=ranks,
+                                              sampler=sampler.state_dict((i + 1) * dataloader.batch_size))
+                        checkpoints.save(training_state, global_step)
+            profiler.step()
+        skip_batches = 0
+        if main_process:
+            profiler.report(epoch, sink)
 
         # Update learning rates
         lr_scheduler_G.step()
@@ -212,8 +474,13 @@ if __name__ == '__main__':
         lr_scheduler_D_B.step()
 
         # Save models checkpoints
-        torch.save(netG_A2B.state_dict(), 'output/netG_A2B.pth')
-        torch.save(netG_B2A.state_dict(), 'output/netG_B2A.pth')
-        torch.save(netD_A.state_dict(), 'output/netD_A.pth')
-        torch.save(netD_B.state_dict(), 'output/netD_B.pth')
+        if main_process:
+            atomic_save(netG_A2B.state_dict(), 'output/netG_A2B.pth')
+            atomic_save(netG_B2A.state_dict(), 'output/netG_B2A.pth')
+            atomic_save(netD_A.state_dict(), 'output/netD_A.pth')
+            atomic_save(netD_B.state_dict(), 'output/netD_B.pth')
+    checkpoints.wait()
+    logger.close()
+    if opt.distributed:
+        torch.distributed.destroy_process_group()
     ###################################
@@ -1,12 +1,14 @@
-import random
+import csv
+import json
+import os
+import queue
+import threading
 import time
 import datetime
 import sys
 
 from torch import nn
-from torch.autograd import Variable
 import torch
-from visdom import Visdom
 import numpy as np
 
 
@@ -17,94 +19,229 @@ def tensor2image(tensor):
     return image.astype(np.uint8)
 
 
+class MetricsSink():
+    """Append-only metrics file: JSON lines, or CSV when the path ends with .csv."""
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.writer = None
+        self.fields = None
+        if path.endswith('.csv') and os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, newline='') as f:
+                self.fields = next(csv.reader(f))
+        self.file = open(path, 'a', newline='' if path.endswith('.csv') else None)
+
+    def write(self, record):
+        if not self.path.endswith('.csv'):
+            self.file.write(json.dumps(record) + '\n')
+        else:
+            if self.writer is None:
+                new_file = self.fields is None
+                self.fields = self.fields or list(record.keys())
+                self.writer = csv.DictWriter(self.file, self.fields, extrasaction='ignore')
+                if new_file:
+                    self.writer.writeheader()
+            self.writer.writerow(record)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
 class Logger():
-    def __init__(self, n_epochs, batches_epoch):
-        self.viz = Visdom()
+    def __init__(self, n_epochs, batches_epoch, log_every=10, visdom=True, sink=None, queue_size=16, verbose=True):
         self.n_epochs = n_epochs
         self.batches_epoch = batches_epoch
+        self.log_every = log_every
+        self.sink = sink
+        self.verbose = verbose
         self.epoch = 1
         self.batch = 1
         self.prev_time = time.time()
         self.mean_period = 0
         self.losses = {}
-        self.loss_windows = {}
-        self.image_windows = {}
+        self.pending = {}
+        self.means = {}
+        self.dropped = 0
 
-    def log(self, losses=None, images=None):
-        self.mean_period += (time.time() - self.prev_time)
-        self.prev_time = time.time()
+        # Visdom calls are HTTP round trips, so they run on their own thread
+        self.viz_queue = None
+        if visdom:
+            from visdom import Visdom
 
-        sys.stdout.write(
-            '\rEpoch %03d/%03d [%04d/%04d] -- ' % (self.epoch, self.n_epochs, self.batch, self.batches_epoch))
+            self.viz_queue = queue.Queue(maxsize=queue_size)
+            self.viz_thread = threading.Thread(target=self._viz_worker, args=(Visdom,), daemon=True)
+            self.viz_thread.start()
 
-        for i, loss_name in enumerate(losses.keys()):
-            if loss_name not in self.losses:
-                self.losses[loss_name] = losses[loss_name].item()
+    def _viz_worker(self, Visdom):
+        viz = Visdom()
+        loss_windows = {}
+        image_windows = {}
+        while True:
+            item = self.viz_queue.get()
+            if item is None:
+                break
+            kind, name, value, epoch = item
+            if kind == 'image':
+                if name not in image_windows:
+                    image_windows[name] = viz.image(tensor2image(value), opts={'title': name})
+                else:
+                    viz.image(tensor2image(value), win=image_windows[name], opts={'title': name})
+            elif name not in loss_windows:
+                loss_windows[name] = viz.line(X=np.array([epoch]), Y=np.array([value]),
+                                              opts={'xlabel': 'epochs', 'ylabel': name, 'title': name})
             else:
-                self.losses[loss_name] += losses[loss_name].item()
+                viz.line(X=np.array([epoch]), Y=np.array([value]), win=loss_windows[name], update='append')
 
-            if (i + 1) == len(losses.keys()):
-                sys.stdout.write('%s: %.4f -- ' % (loss_name, self.losses[loss_name] / self.batch))
-            else:
-                sys.stdout.write('%s: %.4f | ' % (loss_name, self.losses[loss_name] / self.batch))
+    def _post(self, item):
+        if self.viz_queue is None:
+            return
+        try:
+            self.viz_queue.put_nowait(item)
+        except queue.Full:
+            # Never stall training on the plotting backend
+            self.dropped += 1
+
+    def _reduce(self):
+        # One device sync for all losses accumulated since the last reduction
+        names = list(self.pending.keys())
+        values = torch.stack([self.pending[name].float() for name in names]).tolist()
+        self.pending = {}
+        for loss_name, value in zip(names, values):
+            self.losses[loss_name] = self.losses.get(loss_name, 0.0) + value
+            self.means[loss_name] = self.losses[loss_name] / self.batch
+
+        if self.verbose:
+            self._print()
 
+        if self.sink is not None:
+            self.sink.write(dict({'kind': 'step', 'epoch': self.epoch, 'batch': self.batch, 'time': time.time()},
+                                 **self.means))
+
+    def _print(self):
+        sys.stdout.write(
+            '\rEpoch %03d/%03d [%04d/%04d] -- ' % (self.epoch, self.n_epochs, self.batch, self.batches_epoch))
+        sys.stdout.write(' | '.join('%s: %.4f' % (name, mean) for name, mean in self.means.items()))
         batches_done = self.batches_epoch * (self.epoch - 1) + self.batch
         batches_left = self.batches_epoch * (self.n_epochs - self.epoch) + self.batches_epoch - self.batch
-        sys.stdout.write('ETA: %s' % (datetime.timedelta(seconds=batches_left * self.mean_period / batches_done)))
+        sys.stdout.write(' -- ETA: %s' % (datetime.timedelta(seconds=batches_left * self.mean_period / batches_done)))
+
+    def log(self, losses=None, images=None):
+        self.mean_period += (time.time() - self.prev_time)
+        self.prev_time = time.time()
+
+        # Keep running sums on the device; nothing here waits for the step to finish
+        for loss_name, loss in losses.items():
+            loss = loss.detach()
+            self.pending[loss_name] = self.pending[loss_name] + loss if loss_name in self.pending else loss
+
+        end_of_epoch = (self.batch % self.batches_epoch) == 0
+        if (self.batch % self.log_every) == 0 or end_of_epoch:
+            self._reduce()
 
         # Draw images
-        if (self.batch % 10) == 0:
+        if (self.batch % 10) == 0 and images is not None and self.viz_queue is not None:
             for image_name, tensor in images.items():
-                if image_name not in self.image_windows:
-                    self.image_windows[image_name] = self.viz.image(tensor2image(tensor.data),
-                                                                    opts={'title': image_name})
-                else:
-                    self.viz.image(tensor2image(tensor.data), win=self.image_windows[image_name],
-                                   opts={'title': image_name})
+                # Inputs are overwritten in place by the next step, so hand over a copy
+                self._post(('image', image_name, tensor[:1].detach().clone(), self.epoch))
 
         # End of epoch
-        if (self.batch % self.batches_epoch) == 0:
+        if end_of_epoch:
             # Plot losses
             for loss_name, loss in self.losses.items():
-                if loss_name not in self.loss_windows:
-                    self.loss_windows[loss_name] = self.viz.line(X=np.array([self.epoch]),
-                                                                 Y=np.array([loss / self.batch]),
-                                                                 opts={'xlabel': 'epochs', 'ylabel': loss_name,
-                                                                       'title': loss_name})
-                else:
-                    self.viz.line(X=np.array([self.epoch]), Y=np.array([loss / self.batch]),
-                                  win=self.loss_windows[loss_name], update='append')
+                self._post(('line', loss_name, loss / self.batch, self.epoch))
                 # Reset losses for next epoch
                 self.losses[loss_name] = 0.0
+            if self.sink is not None:
+                self.sink.write(dict({'kind': 'epoch', 'epoch': self.epoch, 'time': time.time(),
+                                      'dropped_plots': self.dropped}, **self.means))
 
             self.epoch += 1
             self.batch = 1
-            sys.stdout.write('\n')
+            if self.verbose:
+                sys.stdout.write('\n')
         else:
             self.batch += 1
 
+    def state_dict(self):
+        losses = dict(self.losses)
+        for loss_name, value in self.pending.items():
+            losses[loss_name] = losses.get(loss_name, 0.0) + value.item()
+        return {'epoch': self.epoch, 'batch': self.batch, 'losses': losses, 'mean_period': self.mean_period}
+
+    def load_state_dict(self, state_dict):
+        self.epoch = state_dict['epoch']
+        self.batch = state_dict['batch']
+        self.losses = dict(state_dict['losses'])
+        self.mean_period = state_dict['mean_period']
+        self.pending = {}
+        self.prev_time = time.time()
+
+    def close(self):
+        if self.viz_queue is not None:
+            self.viz_queue.put(None)
+            self.viz_thread.join()
+        if self.sink is not None:
+            self.sink.close()
+
 
 class ReplayBuffer():
-    def __init__(self, max_size=50):
+    def __init__(self, max_size=50, seed=None):
         assert (max_size > 0), 'Empty buffer or trying to create a black hole. Be careful.'
         self.max_size = max_size
-        self.data = []
+        self.data = None  # (max_size, C, H, W) on the device of the first push
+        self.size = 0
+        if seed is None:
+            seed = int(torch.randint(2 ** 62, (1,)).item())
+        self.generator = torch.Generator().manual_seed(seed)
 
     def push_and_pop(self, data):
-        to_return = []
-        for element in data.data:
-            element = torch.unsqueeze(element, 0)
-            if len(self.data) < self.max_size:
-                self.data.append(element)
-                to_return.append(element)
-            else:
-                if random.uniform(0, 1) > 0.5:
-                    i = random.randint(0, self.max_size - 1)
-                    to_return.append(self.data[i].clone())
-                    self.data[i] = element
-                else:
-                    to_return.append(element)
-        return Variable(torch.cat(to_return))
+        data = data.detach()
+        if self.data is None:
+            self.data = torch.empty((self.max_size,) + data.shape[1:], dtype=data.dtype, device=data.device)
+        elif self.data.device != data.device:
+            self.data = self.data.to(data.device)
+        to_return = data.clone()
+
+        # While the buffer fills up, elements are stored and returned as-is
+        n_fill = min(len(data), self.max_size - self.size)
+        self.data[self.size:self.size + n_fill] = data[:n_fill]
+        self.size += n_fill
+
+        # Afterwards each element is swapped with a random stored one with probability 0.5.
+        # Draws happen on the CPU generator so nothing waits on the device.
+        swap = (torch.rand(len(data) - n_fill, generator=self.generator) > 0.5).nonzero().squeeze(1) + n_fill
+        if len(swap) == 0:
+            return to_return
+        slots = torch.randint(0, self.max_size, (len(swap),), generator=self.generator)
+
+        # A slot drawn twice in one batch hands back what the earlier swap just put there,
+        # and only the last swap into a slot is kept, exactly like swapping one by one
+        order = torch.arange(len(slots))
+        same = slots[:, None] == slots[None, :]
+        earlier = same & (order[None, :] < order[:, None])
+        later = same & (order[None, :] > order[:, None])
+        has_earlier = earlier.any(1)
+        last = ~later.any(1)
+
+        device = data.device
+        popped = self.data[slots.to(device)]
+        if has_earlier.any():
+            previous = (earlier * (order + 1)).argmax(1)
+            popped[has_earlier.to(device)] = data[swap[previous[has_earlier]].to(device)]
+        to_return[swap.to(device)] = popped
+        self.data[slots[last].to(device)] = data[swap[last].to(device)]
+        return to_return
+
+    def state_dict(self):
+        return {'data': self.data, 'size': self.size, 'generator': self.generator.get_state()}
+
+    def load_state_dict(self, state_dict):
+        self.data = state_dict['data']
+        self.size = state_dict['size']
+        self.generator.set_state(state_dict['generator'])
 
 
 class LambdaLR():